@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+CONTENT-ADDRESSED CACHE FOR EPANET-MSX RUNS
+
+Stores the .bin/.rpt of a run under the SHA-256 of everything that determines
+it: INP file content, MSX file content, engine files and run options. A
+repeated run is served from the cache without starting the engine.
+
+Layout:
+    <cache_dir>/<key[:2]>/<key>/result.bin, result.rpt, meta.json
+
+Entries are built in a scratch directory and renamed into place, so readers
+never see partial entries and several processes can share one cache.
+Eviction (least recently used first, over max_bytes) and invalidation hold a
+lock file.
+
+"""
+
+import ast
+import glob
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from msx_tools import _check_bin
+
+
+cache_location = os.path.join(os.path.expanduser('~'), '.msx_tools', 'results')
+_engine_fingerprints = {}
+
+
+def _file_digest(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _script_modules(script):
+    ## the python script plus the modules next to it that it imports, recursively
+    directory = os.path.dirname(os.path.abspath(script))
+    found = []
+    pending = [os.path.abspath(script)]
+    while pending:
+        f = pending.pop()
+        if f in found:
+            continue
+        found.append(f)
+        try:
+            with open(f, 'rb') as fin:
+                tree = ast.parse(fin.read(), filename=f)
+        except (OSError, SyntaxError, ValueError):
+            continue
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module is not None:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                module = os.path.join(directory, name.split('.')[0] + '.py')
+                if os.path.isfile(module):
+                    pending.append(module)
+    return found
+
+
+def _engine_fingerprint(command, engine_dir):
+    ## engine executable/script plus the DLLs next to it, and for a python engine
+    ## the modules it imports from its directory, memoized on (path, size, mtime)
+    files = [c for c in command if os.path.isfile(c) and c != sys.executable]
+    files += sorted(glob.glob(os.path.join(engine_dir, '*.dll')))
+    for script in [f for f in files if f.endswith('.py')]:
+        ## this module is imported by msx_tools but has no part in a run
+        files += [f for f in _script_modules(script) if f != os.path.abspath(__file__)]
+    parts = []
+    for f in sorted(set(os.path.abspath(f) for f in files)):
+        stat = os.stat(f)
+        memo_key = (f, stat.st_size, stat.st_mtime_ns)
+        if memo_key not in _engine_fingerprints:
+            _engine_fingerprints[memo_key] = _file_digest(f)
+        parts.append(f"{os.path.basename(f)}:{_engine_fingerprints[memo_key]}")
+    return ';'.join(parts)
+
+
+class MSXRunCache():
+    def __init__(self, cache_dir=None, max_bytes=5*2**30, lock_timeout=60):
+        '''
+        Cache of EPANET-MSX results.
+
+        Parameters
+        ----------
+        cache_dir : string, optional
+            cache directory. The default is None (~/.msx_tools/results).
+        max_bytes : int, optional
+            size cap, least recently used entries are evicted above it.
+            The default is 5 GB.
+        lock_timeout : float, optional
+            seconds after which a lock file is considered stale. The default is 60.
+
+        '''
+        self.cache_dir = os.path.abspath(cache_dir if cache_dir is not None else cache_location)
+        self.max_bytes = max_bytes
+        self.lock_timeout = lock_timeout
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, inpfile, msxfile, command, engine_dir, options=None):
+        '''
+        Cache key of a run: SHA-256 over the INP and MSX file contents, the
+        engine files and the run options (dictionary).
+        '''
+        h = hashlib.sha256()
+        h.update(b'inp\0' + _file_digest(inpfile).encode())
+        h.update(b'msx\0' + _file_digest(msxfile).encode())
+        h.update(b'engine\0' + _engine_fingerprint(command, engine_dir).encode())
+        h.update(b'options\0' + json.dumps(options if options is not None else {}, sort_keys=True,
+                                           default=str).encode())
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key, job_base):
+        '''
+        Copies a cached result to job_base + '.bin'/'.rpt'. Returns the two
+        file names (the .rpt is None if the run was stored without one, and
+        an older job_base + '.rpt' is removed), or None on a miss. An entry
+        missing a file it was stored with is a miss.
+        '''
+        entry = self._entry(key)
+        if not os.path.isdir(entry):
+            self.misses += 1
+            return None
+        try:
+            with open(os.path.join(entry, 'meta.json'), 'r') as f:
+                has_rpt = json.load(f).get('has_rpt', True)
+            shutil.copyfile(os.path.join(entry, 'result.bin'), job_base + '.bin')
+            if has_rpt:
+                shutil.copyfile(os.path.join(entry, 'result.rpt'), job_base + '.rpt')
+            elif os.path.exists(job_base + '.rpt'):
+                os.remove(job_base + '.rpt') ## from an earlier run, not this result
+            os.utime(entry) ## recently used
+        except (OSError, ValueError):
+            ## evicted while copying, or incomplete
+            self.misses += 1
+            return None
+        self.hits += 1
+        return job_base + '.bin', job_base + '.rpt' if has_rpt else None
+
+    def put(self, key, binfile, rptfile=None, meta=None):
+        '''
+        Stores a finished run. Runs without a valid, error free binary file
+        are not stored. Returns True if the entry exists afterwards.
+        '''
+        status, message = _check_bin(binfile)
+        if status != 'ok':
+            print(f"WARNING: result not cached: {message}")
+            return False
+        entry = self._entry(key)
+        if os.path.isdir(entry):
+            return True
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        scratch = tempfile.mkdtemp(prefix=f'.{key[:8]}_', dir=os.path.dirname(entry))
+        try:
+            shutil.copyfile(binfile, os.path.join(scratch, 'result.bin'))
+            has_rpt = rptfile is not None and os.path.exists(rptfile)
+            if has_rpt:
+                shutil.copyfile(rptfile, os.path.join(scratch, 'result.rpt'))
+            with open(os.path.join(scratch, 'meta.json'), 'w') as f:
+                json.dump(dict(meta if meta is not None else {}, created=time.time(), has_rpt=has_rpt), f,
+                          default=str)
+            os.rename(scratch, entry) ## atomic, fails if another runner stored it first
+        except OSError:
+            shutil.rmtree(scratch, ignore_errors=True)
+            return os.path.isdir(entry)
+        self.evict()
+        return True
+
+    def entries(self):
+        '''
+        (key, bytes, last use time) of every entry, oldest first.
+        '''
+        out = []
+        for entry in glob.glob(os.path.join(self.cache_dir, '??', '*')):
+            key = os.path.basename(entry)
+            if key.startswith('.') or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                out.append((key, size, os.path.getmtime(entry)))
+            except OSError:
+                continue
+        return sorted(out, key=lambda item: item[2])
+
+    def size(self):
+        return sum(item[1] for item in self.entries())
+
+    def evict(self, max_bytes=None):
+        '''
+        Removes least recently used entries until the cache is under
+        max_bytes (default: the cache size cap). Returns the removed keys.
+        '''
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        removed = []
+        with self._lock():
+            entries = self.entries()
+            total = sum(item[1] for item in entries)
+            for key, size, used in entries:
+                if total <= max_bytes:
+                    break
+                self._remove(key)
+                total -= size
+                removed.append(key)
+        return removed
+
+    def invalidate(self, key=None):
+        '''
+        Removes one entry, or every entry if key is None.
+        '''
+        with self._lock():
+            keys = [key] if key is not None else [item[0] for item in self.entries()]
+            for k in keys:
+                self._remove(k)
+
+    def _remove(self, key):
+        ## rename first so readers never see a half deleted entry
+        entry = self._entry(key)
+        trash = os.path.join(os.path.dirname(entry), f".{key}.{os.getpid()}.del")
+        try:
+            os.rename(entry, trash)
+        except OSError:
+            return
+        shutil.rmtree(trash, ignore_errors=True)
+
+    def _lock(self):
+        return _LockFile(os.path.join(self.cache_dir, '.lock'), self.lock_timeout)
+
+
+class _LockFile():
+    ## exclusive lock through O_EXCL file creation, works on Windows and Linux
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.timeout = timeout
+
+    def __enter__(self):
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, str(os.getpid()).encode())
+                os.close(fd)
+                return self
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.path) > self.timeout:
+                        os.remove(self.path) ## stale lock of a crashed process
+                        continue
+                except OSError:
+                    continue
+                time.sleep(0.05)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def as_cache(cache):
+    ## run_msx(cache=...) accepts True (default location), a directory or an MSXRunCache
+    if cache is None or cache is False:
+        return None
+    if isinstance(cache, MSXRunCache):
+        return cache
+    if cache is True:
+        return MSXRunCache()
+    return MSXRunCache(cache)
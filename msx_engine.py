@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+"""
+PYTHON/NUMPY STAND-IN FOR THE EPANET-MSX ENGINE
+
+Lagrangian plug-flow transport of MSX species on WNTR hydraulic results,
+for platforms where the bundled Windows engine cannot run. Pipes hold
+segments of water that move with the flow; nodes mix their inflows
+completely; tanks are completely mixed reactors. Bulk reactions are
+evaluated for all pipe segments at once with msx_kinetics. Results are
+written in the EPANET-MSX binary format, so MSXBinReader reads them as usual.
+
+Not a replacement for EPANET-MSX: no dispersion, no EQUIL reactions, tanks
+are always completely mixed, nodes use the upstream concentration of the
+previous quality step, and wall species stay with their pipe (averaged over
+its segments).
+
+Usage (same arguments as runepanetmsx.exe):
+    python msx_engine.py network.inp model.msx report.rpt results.bin
+
+or run_msx(inpfile, msxfile, engine='python').
+
+"""
+
+import math
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import wntr
+from wntr.epanet.util import FlowUnits
+
+from msx_tools import MSXobj, MSXBinWriter, read_inp_index
+from msx_profiling import span
+
+
+water_viscosity = 1.1e-6 ## m2/s at 20 C
+area_units_m2 = {'M2': 1., 'FT2': 1./0.3048**2, 'CM2': 1.e4}
+
+
+def msx_hydraulics(inpfile, file_prefix=None, wn=None):
+    '''
+    Runs the EPANET hydraulics (WNTR EpanetSimulator) reporting every
+    hydraulic timestep. The result can be passed to simulate_msx to reuse one
+    hydraulic run for many quality runs.
+
+    Parameters
+    ----------
+    inpfile : string
+        EPANET INP file
+    file_prefix : string, optional
+        prefix of the EPANET scratch files. The default is None (temporary directory).
+    wn : wntr WaterNetworkModel, optional
+        model of inpfile if already built. The default is None (built here).
+
+    Returns
+    -------
+    dictionary
+        'times' (s), 'flow' (time, link) m3/s, 'demand' (time, node) m3/s,
+        'level' (time, node) m (tank levels, 0 elsewhere), nodes and links in
+        EPANET order
+
+    '''
+    index = read_inp_index(inpfile)
+    if wn is None:
+        with span('wntr_model'):
+            wn = wntr.network.WaterNetworkModel(inpfile)
+    report_times = wn.options.time.report_timestep, wn.options.time.report_start
+    wn.options.time.report_timestep = wn.options.time.hydraulic_timestep
+    wn.options.time.report_start = 0
+    try:
+        with tempfile.TemporaryDirectory(prefix='msx_hyd_') as scratch, span('hydraulics'):
+            if file_prefix is None:
+                file_prefix = os.path.join(scratch, 'hyd')
+            results = wntr.sim.EpanetSimulator(wn).run_sim(file_prefix=file_prefix)
+    finally:
+        wn.options.time.report_timestep, wn.options.time.report_start = report_times
+
+    nodes = index['nodes']
+    links = index['links']
+    level = results.node['pressure'][nodes].to_numpy(dtype=float, copy=True)
+    for i, name in enumerate(nodes):
+        if wn.get_node(name).node_type != 'Tank':
+            level[:, i] = 0.
+    return {'times': results.link['flowrate'].index.to_numpy(dtype=float),
+            'flow': results.link['flowrate'][links].to_numpy(dtype=float),
+            'demand': results.node['demand'][nodes].to_numpy(dtype=float),
+            'level': level}
+
+
+def _float(value, default=0.):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _sum_by(index, values, n):
+    ## sums of the rows of values (row, column) per index, shape (n, column)
+    return np.stack([np.bincount(index, weights=values[:, k], minlength=n) for k in range(values.shape[1])], axis=1)
+
+
+def _pattern_value(msxobj, pattern, t, pattern_start, pattern_step):
+    ## MSX patterns step with the INP pattern timestep
+    if pattern in ['', None] or pattern not in msxobj.patterns.keys():
+        return 1.
+    values = msxobj.patterns[pattern]
+    if len(values) == 0:
+        return 1.
+    return float(values[int((t + pattern_start) // pattern_step) % len(values)])
+
+
+def simulate_msx(inpfile, msx, binfile, rptfile=None, hydraulics=None):
+    '''
+    Runs a water quality simulation with the python transport engine.
+
+    Parameters
+    ----------
+    inpfile : string
+        EPANET INP file
+    msx : MSXobj or string
+        model, or the name of an .msx file
+    binfile : string
+        EPANET-MSX binary output to write
+    rptfile : string, optional
+        short text report. The default is None (no report).
+    hydraulics : dictionary, optional
+        output of msx_hydraulics for this INP file. The default is None
+        (hydraulics are run).
+
+    Returns
+    -------
+    binfile : string
+
+    '''
+    start_wall = time.perf_counter()
+    if isinstance(msx, str):
+        msx = MSXobj(file_name=msx)
+    warnings = []
+    def warn(text):
+        print(f"WARNING: {text}")
+        warnings.append(text)
+
+    index = read_inp_index(inpfile)
+    with span('wntr_model'):
+        wn = wntr.network.WaterNetworkModel(inpfile)
+    if hydraulics is None:
+        hydraulics = msx_hydraulics(inpfile, wn=wn)
+    node_list = index['nodes']
+    link_list = index['links']
+    nnodes = len(node_list)
+    nlinks = len(link_list)
+    node_pos = {name: i for i, name in enumerate(node_list)}
+    link_pos = {name: i for i, name in enumerate(link_list)}
+
+    species = list(msx.species.keys())
+    nsp = len(species)
+    units = [str(msx.species[s]['val']) for s in species]
+    wall = np.array([str(msx.species[s]['type']).upper() == 'WALL' for s in species])
+    bulk = ~wall
+    options = {key.lower(): msx.options[key]['val'] for key in msx.options.keys()}
+    method = {'EUL': 'euler', 'RK5': 'rk45', 'ROS2': 'rk45'}.get(str(options.get('solver', 'RK5')).upper(), 'rk4')
+    ctol = _float(options.get('atol', 1e-4), 1e-4)
+    pipe_reactor = msx.batch_reactor('pipes')
+    tank_reactor = msx.batch_reactor('tanks')
+
+    ## ---------------- network data ----------------
+    flow_units = FlowUnits[wn.options.hydraulic.inpfile_units.upper()]
+    length_factor = 1./0.3048 if flow_units.is_traditional else 1.
+    area_factor = area_units_m2.get(str(options.get('area_units', 'M2')).upper(), 1.)
+
+    start_node = np.empty(nlinks, dtype=int)
+    end_node = np.empty(nlinks, dtype=int)
+    diameter = np.zeros(nlinks)
+    length = np.zeros(nlinks)
+    roughness = np.zeros(nlinks)
+    for i, name in enumerate(link_list):
+        link = wn.get_link(name)
+        start_node[i] = node_pos[link.start_node_name]
+        end_node[i] = node_pos[link.end_node_name]
+        if link.link_type == 'Pipe':
+            diameter[i] = link.diameter
+            length[i] = link.length
+            roughness[i] = link.roughness
+    volume = np.pi / 4. * diameter**2 * length ## m3, 0 for pumps and valves
+    pipes = np.nonzero(volume > 0)[0]
+
+    node_type = [wn.get_node(name).node_type for name in node_list]
+    tanks = [i for i in range(nnodes) if node_type[i] == 'Tank']
+    reservoirs = [i for i in range(nnodes) if node_type[i] == 'Reservoir']
+    tank_objs = {i: wn.get_node(node_list[i]) for i in tanks}
+
+    ## ---------------- coefficients (PARAMETERS) ----------------
+    pipe_coeffs = {}
+    tank_coeffs = {}
+    for row in msx.parameters:
+        loc, ID, coeff, value = row[0].upper(), row[1], row[2], _float(row[3])
+        if coeff not in pipe_reactor.coefficients:
+            warn(f"PARAMETERS: {coeff} is not a coefficient")
+            continue
+        if loc == 'PIPE' and ID in link_pos:
+            pipe_coeffs.setdefault(coeff, np.full(nlinks, pipe_reactor.coefficients[coeff]))[link_pos[ID]] = value
+        elif loc == 'TANK' and ID in node_pos:
+            tank_coeffs.setdefault(coeff, np.full(nnodes, tank_reactor.coefficients[coeff]))[node_pos[ID]] = value
+        else:
+            warn(f"PARAMETERS: {loc} {ID} not found in the network")
+
+    ## ---------------- initial quality ----------------
+    node_c = np.zeros((nnodes, nsp))
+    link_c = np.zeros((nlinks, nsp))
+    for row in msx.quality:
+        loc = row[0].upper()
+        if loc == 'GLOBAL' and row[1] in species:
+            node_c[:, species.index(row[1])] = _float(row[2])
+            link_c[:, species.index(row[1])] = _float(row[2])
+    for row in msx.quality:
+        loc = row[0].upper()
+        if loc in ['NODE', 'LINK'] and len(row) > 3 and row[2] in species:
+            if loc == 'NODE' and row[1] in node_pos:
+                node_c[node_pos[row[1]], species.index(row[2])] = _float(row[3])
+            elif loc == 'LINK' and row[1] in link_pos:
+                link_c[link_pos[row[1]], species.index(row[2])] = _float(row[3])
+            else:
+                warn(f"QUALITY: {loc} {row[1]} not found in the network")
+        elif loc != 'GLOBAL':
+            warn(f"QUALITY: cannot use {row}")
+    reservoir_c = node_c.copy()
+    wall_c = link_c * wall ## wall species stay with their link
+
+    ## segments of all links in flat arrays, grouped by link, downstream end
+    ## first: link, volume (m3) and (segment, species) concentrations
+    seg_link = pipes.copy()
+    seg_vol = volume[pipes].copy()
+    seg_c = link_c[pipes].copy()
+    direction = np.ones(nlinks)
+
+    ## ---------------- sources ----------------
+    sources = []
+    concen = np.zeros((nnodes, nsp), dtype=bool)
+    for row in msx.sources:
+        source_type, ID, specie, value = row[0].upper(), row[1], row[2], _float(row[3])
+        pattern = row[4] if len(row) > 4 else ''
+        if ID not in node_pos or specie not in species:
+            warn(f"SOURCES: {ID} {specie} not found")
+            continue
+        sources.append((source_type, node_pos[ID], species.index(specie), value, pattern))
+        if source_type == 'CONCEN':
+            concen[node_pos[ID], species.index(specie)] = True
+
+    ## ---------------- time stepping ----------------
+    times = index['times']
+    duration = int(times['duration'])
+    report_step = int(times['report_timestep'])
+    report_start = int(times['report_start'])
+    dt = math.gcd(int(_float(options.get('timestep', 300), 300)), report_step)
+    if report_start > 0:
+        dt = math.gcd(dt, report_start)
+    dt = max(dt, 1)
+    htimes = hydraulics['times']
+    is_junction = np.array([node_type[n] == 'Junction' for n in range(nnodes)])
+    reacting_pipes = len(pipe_reactor._rates) + len(pipe_reactor._formulas) > 0
+    reacting_tanks = len(tanks) > 0 and len(tank_reactor._rates) + len(tank_reactor._formulas) > 0
+
+    def link_hydraulics(q):
+        ## MSX hydraulic variables per link, in INP units
+        d = np.where(diameter > 0, diameter, 1.)
+        u = np.abs(q) / (np.pi / 4. * d**2)
+        re = u * d / water_viscosity
+        ff = np.where(re < 2000., 64. / np.maximum(re, 1.), 0.316 / np.maximum(re, 1.)**0.25)
+        return {'D': diameter * length_factor,
+                'Q': np.abs(q) / flow_units.factor,
+                'U': u * length_factor,
+                'Re': re,
+                'Ff': ff,
+                'Us': u * np.sqrt(ff / 8.) * length_factor,
+                'Av': np.where(diameter > 0, 4. / d * area_factor / 1000., 0.),
+                'Kc': roughness,
+                'Len': length * length_factor}
+
+    nsteps = (duration - report_start) // report_step + 1
+    with MSXBinWriter(binfile, nnodes, nlinks, species, units=units, reportstep=report_step) as writer:
+        out = np.zeros((nsp, nnodes + nlinks), dtype=np.float32)
+
+        def report():
+            out[:, :nnodes] = (node_c * bulk).T
+            c = node_c[np.where(direction > 0, start_node, end_node)]
+            totals = np.bincount(seg_link, weights=seg_vol, minlength=nlinks)
+            has = totals > 0
+            c[has] = _sum_by(seg_link, seg_vol[:, None] * seg_c, nlinks)[has] / totals[has, None]
+            out[:, nnodes:] = np.where(wall, wall_c, c).T
+            writer.write_step(out)
+            writer.flush() ## visible to MSXBinFollower while the run continues
+
+        t = 0
+        h_last = -1
+        while True:
+            if t >= report_start and (t - report_start) % report_step == 0 and writer.numreport < nsteps:
+                report()
+            if t >= duration:
+                break
+            h = max(int(np.searchsorted(htimes, t, side='right')) - 1, 0)
+            if h != h_last:
+                q = hydraulics['flow'][h]
+                demand = hydraulics['demand'][h]
+                link_hyd = link_hydraulics(q)
+                moved = np.abs(q) * dt
+                moving = moved > 0
+                sign = np.where(q > 0, 1., -1.)
+                up = np.where(sign > 0, start_node, end_node)
+                down = np.where(sign > 0, end_node, start_node)
+                external = np.where(demand < 0, -demand * dt, 0.)
+                tank_volume = {n: tank_objs[n].get_volume(hydraulics['level'][h, n]) for n in tanks}
+                h_last = h
+
+            ## reactions, all pipe segments at once
+            if reacting_pipes and len(seg_vol) > 0:
+                C = seg_c.T.copy()
+                C[wall] = wall_c[seg_link][:, wall].T
+                hyd = {key: val[seg_link] for key, val in link_hyd.items()}
+                coeffs = {key: val[seg_link] for key, val in pipe_coeffs.items()}
+                C = pipe_reactor.step(C, dt, coeffs, hyd, method)
+                if wall.any():
+                    totals = np.bincount(seg_link, weights=seg_vol, minlength=nlinks)
+                    has = totals > 0
+                    weighted = _sum_by(seg_link, (C[wall] * seg_vol).T, nlinks)
+                    wall_c[np.ix_(has, wall)] = weighted[has] / totals[has, None]
+                seg_c = np.ascontiguousarray(C.T)
+            if reacting_tanks:
+                C = node_c[tanks].T.copy()
+                coeffs = {key: val[tanks] for key, val in tank_coeffs.items()}
+                node_c[tanks] = tank_reactor.step(C, dt, coeffs, None, method).T
+
+            ## transport, all links at once: water enters each link at its
+            ## upstream node and leaves at the downstream node
+            counts = np.bincount(seg_link, minlength=nlinks)
+            starts = np.cumsum(counts) - counts
+            flip = moving & (sign != direction)
+            if flip.any():
+                ## flow reversed, the upstream end becomes the downstream end
+                order = np.arange(len(seg_vol))
+                flipped = flip[seg_link]
+                links = seg_link[flipped]
+                order[flipped] = 2 * starts[links] + counts[links] - 1 - order[flipped]
+                seg_vol = seg_vol[order]
+                seg_c = seg_c[order]
+            direction[moving] = sign[moving]
+
+            ## the inflow joins the upstream segment if its concentration is close enough
+            ends = starts + counts
+            c_up = node_c[up]
+            join = moving & (counts > 0)
+            join[join] = np.abs(seg_c[ends[join] - 1] - c_up[join]).max(axis=1) <= ctol
+            seg_vol[ends[join] - 1] += moved[join]
+            new = moving & ~join
+            if new.any():
+                ## otherwise a new upstream segment, placed after the segments of its link
+                shift = np.cumsum(new) - new
+                old_pos = np.arange(len(seg_vol)) + shift[seg_link]
+                new_pos = (ends + shift)[new]
+                total = len(seg_vol) + len(new_pos)
+                vols, concs, links = np.empty(total), np.empty((total, nsp)), np.empty(total, dtype=seg_link.dtype)
+                vols[old_pos], concs[old_pos], links[old_pos] = seg_vol, seg_c, seg_link
+                vols[new_pos], concs[new_pos], links[new_pos] = moved[new], c_up[new], np.nonzero(new)[0]
+                seg_vol, seg_c, seg_link = vols, concs, links
+
+            ## the same volume leaves at the downstream end
+            counts = np.bincount(seg_link, minlength=nlinks)
+            starts = np.cumsum(counts) - counts
+            ahead = np.cumsum(seg_vol) - seg_vol ## volume downstream of each segment
+            ahead -= np.repeat(ahead[starts[counts > 0]], counts[counts > 0])
+            leave = np.clip(moved[seg_link] - ahead, 0., seg_vol)
+            mass = _sum_by(seg_link, leave[:, None] * seg_c, nlinks)
+            seg_vol = seg_vol - leave
+            keep = (leave == 0) | (seg_vol > 1e-12 * (volume + moved)[seg_link])
+            seg_link = seg_link[keep]
+            seg_vol = seg_vol[keep]
+            seg_c = seg_c[keep]
+            vin = np.bincount(down[moving], weights=moved[moving], minlength=nnodes)
+            vout = np.bincount(up[moving], weights=moved[moving], minlength=nnodes)
+            min_ = _sum_by(down, mass, nnodes)
+
+            ## node mixing and sources
+            pattern_args = (t, times['pattern_start'], times['pattern_timestep'])
+            ext_c = np.zeros((nnodes, nsp))
+            for source_type, n, s, value, pattern in sources:
+                if source_type == 'CONCEN':
+                    ext_c[n, s] = value * _pattern_value(msx, pattern, *pattern_args)
+            mix = is_junction & (vin + external > 0)
+            node_c[mix] = (min_[mix] + external[mix, None] * ext_c[mix]) / (vin + external)[mix, None]
+            for n in reservoirs:
+                node_c[n] = np.where(concen[n], ext_c[n], reservoir_c[n])
+            for n in tanks:
+                held = max(tank_volume[n] - vout[n], 0.)
+                if held + vin[n] > 0:
+                    node_c[n] = (node_c[n] * held + min_[n]) / (held + vin[n])
+            for source_type, n, s, value, pattern in sources:
+                value = value * _pattern_value(msx, pattern, *pattern_args)
+                if source_type == 'SETPOINT':
+                    node_c[n, s] = max(node_c[n, s], value)
+                elif source_type == 'FLOWPACED':
+                    node_c[n, s] += value
+                elif source_type == 'MASS':
+                    liters = (vout[n] + max(demand[n], 0.) * dt) * 1000.
+                    if liters > 0:
+                        node_c[n, s] += value * dt / 60. / liters
+
+            t += dt
+
+    wall_time = time.perf_counter() - start_wall
+    if rptfile is not None:
+        with open(rptfile, 'w') as f:
+            f.write("  EPANET-MSX python stand-in engine (msx_engine.py)\n\n")
+            f.write(f"  Input file: {inpfile}\n  Output file: {binfile}\n\n")
+            for text in warnings:
+                f.write(f"  WARNING: {text}\n")
+            f.write(f"\n  {writer.numreport} report steps, quality timestep {dt} s, {wall_time:.2f} s\n")
+    print(f"INFO: {binfile} written, {writer.numreport} report steps in {wall_time:.2f} s")
+    return binfile
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) < 4:
+        print("usage: python msx_engine.py network.inp model.msx report.rpt results.bin")
+        return 1
+    inpfile, msxfile, rptfile, binfile = argv[:4]
+    try:
+        simulate_msx(inpfile, msxfile, binfile, rptfile)
+    except Exception as e:
+        print(f"ERROR: {e}")
+        with open(rptfile, 'a') as f:
+            f.write(f"\n  ERROR: {e}\n")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
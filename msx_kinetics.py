@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+"""
+VECTORIZED REACTION KINETICS FOR MSX MODELS
+
+Compiles the [TERMS], [PIPES]/[TANKS] expressions and [COEFFICIENTS] of an
+MSXobj into NumPy functions, and integrates them in a well-mixed batch reactor
+for many initial-condition/coefficient combinations at once. Every species,
+coefficient and hydraulic variable can be a scalar or an array over the
+batch, so thousands of combinations are evaluated in one call.
+
+Expressions use the EPANET-MSX syntax (+ - * / ^, MSX math functions,
+case-insensitive names) and are parsed with the python ast module.
+
+"""
+
+import ast
+import re
+
+import numpy as np
+
+
+## seconds per rate unit
+rate_unit_seconds = {'SEC': 1., 'MIN': 60., 'HR': 3600., 'HOUR': 3600., 'DAY': 86400.}
+
+## hydraulic variables an MSX expression may use
+hydraulic_variables = ['D', 'Q', 'U', 'Re', 'Us', 'Ff', 'Av', 'Kc', 'Len']
+
+msx_functions = {'abs': np.abs,
+                 'sgn': np.sign,
+                 'sqrt': np.sqrt,
+                 'log': np.log,
+                 'exp': np.exp,
+                 'step': lambda x: np.where(x > 0, 1., 0.),
+                 'log10': np.log10,
+                 'sin': np.sin,
+                 'cos': np.cos,
+                 'tan': np.tan,
+                 'cot': lambda x: 1. / np.tan(x),
+                 'asin': np.arcsin,
+                 'acos': np.arccos,
+                 'atan': np.arctan,
+                 'acot': lambda x: np.pi / 2. - np.arctan(x),
+                 'sinh': np.sinh,
+                 'cosh': np.cosh,
+                 'tanh': np.tanh,
+                 'coth': lambda x: 1. / np.tanh(x)}
+
+_allowed_nodes = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Load, ast.Constant,
+                  ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.USub, ast.UAdd)
+_number_re = re.compile(r'(\d)\.(?=[^\d]|$)') ## "1." -> "1.0"
+
+
+def parse_expression(expr):
+    '''
+    Parses an MSX expression into a python ast.Expression, '^' is read as a
+    power. Raises ValueError for syntax errors or anything that is not
+    arithmetic, a name or an MSX function call.
+    '''
+    text = _number_re.sub(r'\1.0', str(expr).strip()).replace('^', '**')
+    if text == '':
+        raise ValueError('empty expression')
+    try:
+        tree = ast.parse(text, mode='eval')
+    except SyntaxError as e:
+        raise ValueError(f"cannot parse '{expr}': {e.msg}")
+    for node in ast.walk(tree):
+        if not isinstance(node, _allowed_nodes):
+            raise ValueError(f"unsupported syntax '{type(node).__name__}' in '{expr}'")
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id.lower() not in msx_functions:
+                raise ValueError(f"unknown function in '{expr}'")
+            if len(node.args) != 1 or len(node.keywords) > 0:
+                raise ValueError(f"MSX functions take one argument, in '{expr}'")
+    return tree
+
+
+def expression_names(tree):
+    '''
+    Names (species, coefficients, terms, hydraulic variables) used in a
+    parsed expression, function names excluded.
+    '''
+    functions = {id(node.func) for node in ast.walk(tree) if isinstance(node, ast.Call)}
+    return {node.id for node in ast.walk(tree) if isinstance(node, ast.Name) and id(node) not in functions}
+
+
+class _Canonicalize(ast.NodeTransformer):
+    ## MSX names are case-insensitive, rename to the names used in the evaluation namespace
+    def __init__(self, lookup):
+        self.lookup = lookup
+
+    def visit_Call(self, node):
+        node.func = ast.Name(id='_f_' + node.func.id.lower(), ctx=ast.Load())
+        node.args = [self.visit(arg) for arg in node.args]
+        return node
+
+    def visit_Name(self, node):
+        name = self.lookup.get(node.id.lower())
+        if name is None:
+            raise ValueError(f"undefined name '{node.id}'")
+        return ast.copy_location(ast.Name(id=name, ctx=ast.Load()), node)
+
+
+def compile_expression(expr, lookup):
+    '''
+    Compiles an MSX expression for eval() in a namespace of arrays.
+
+    Parameters
+    ----------
+    expr : string
+        MSX expression
+    lookup : dictionary
+        lower case name -> name in the evaluation namespace
+
+    Returns
+    -------
+    code object, set of names used (namespace names)
+
+    '''
+    tree = _Canonicalize(lookup).visit(parse_expression(expr))
+    ast.fix_missing_locations(tree)
+    names = expression_names(tree)
+    return compile(tree, '<msx>', 'eval'), names
+
+
+def term_order(terms, lookup):
+    '''
+    Orders terms so every term comes after the terms it uses. Returns the
+    ordered names, raises ValueError on a cycle.
+    '''
+    term_names = {name.lower(): name for name in terms}
+    depends = {}
+    for name in terms:
+        tree = parse_expression(terms[name])
+        depends[name] = [term_names[n.lower()] for n in expression_names(tree) if n.lower() in term_names]
+
+    order = []
+    state = {} ## 1 visiting, 2 done
+    def visit(name, path):
+        if state.get(name) == 2:
+            return
+        if state.get(name) == 1:
+            raise ValueError(f"term cycle: {' -> '.join(path + [name])}")
+        state[name] = 1
+        for dep in depends[name]:
+            visit(dep, path + [name])
+        state[name] = 2
+        order.append(name)
+    for name in terms:
+        visit(name, [])
+    return order
+
+
+class BatchReactor():
+    def __init__(self, msxobj, location='pipes', hydraulics=None):
+        '''
+        Well-mixed batch reactor for the reactions of an MSXobj.
+
+        Parameters
+        ----------
+        msxobj : MSXobj
+            model providing species, coefficients, terms and reactions
+        location : string, optional
+            'pipes' or 'tanks' reactions. The default is 'pipes'.
+        hydraulics : dictionary, optional
+            values of the hydraulic variables (D, Q, U, Re, Us, Ff, Av, Kc, Len),
+            scalars or arrays over the batch. Missing variables are 0.
+            The default is None.
+
+        '''
+        self.location = location
+        self.species = list(msxobj.species.keys())
+        self.coefficients = {}
+        for name in msxobj.coefficients.keys():
+            try:
+                self.coefficients[name] = float(msxobj.coefficients[name]['val'])
+            except (TypeError, ValueError):
+                print(f"WARNING: COEFFICIENT {name} value {msxobj.coefficients[name]['val']} is not numeric, using 0")
+                self.coefficients[name] = 0.
+        self.hydraulics = {name: 0. for name in hydraulic_variables}
+        if hydraulics is not None:
+            for name in hydraulics.keys():
+                self.hydraulics[name] = hydraulics[name]
+
+        options = {key.lower(): msxobj.options[key]['val'] for key in msxobj.options.keys()}
+        self.rate_units = str(options.get('rate_units', 'MIN')).upper()
+        self.unit_seconds = rate_unit_seconds.get(self.rate_units, 60.)
+        self.solver = str(options.get('solver', 'RK5')).upper()
+        self.timestep = float(options.get('timestep', 60))
+        self.rtol = float(options.get('rtol', 1e-4))
+        self.atol = float(options.get('atol', 1e-4))
+
+        lookup = {}
+        for group in [hydraulic_variables, list(self.coefficients.keys()), list(msxobj.terms.keys()), self.species]:
+            for name in group:
+                lookup[name.lower()] = name
+        self._lookup = lookup
+
+        terms = {name: msxobj.terms[name]['val'] for name in msxobj.terms.keys()}
+        self.term_order = term_order(terms, lookup)
+        self._terms = [(name, compile_expression(terms[name], lookup)[0]) for name in self.term_order]
+
+        reactions = getattr(msxobj, location)
+        self._rates = []
+        self._formulas = []
+        self._equil = []
+        for i, name in enumerate(self.species):
+            if name not in reactions.keys():
+                continue
+            rxn_type = str(reactions[name]['type']).upper()
+            code = compile_expression(reactions[name]['val'], lookup)[0]
+            if rxn_type == 'RATE':
+                self._rates.append((i, code))
+            elif rxn_type == 'FORMULA':
+                self._formulas.append((i, code))
+            elif rxn_type == 'EQUIL':
+                self._equil.append(name)
+        if len(self._equil) > 0:
+            print(f"WARNING: EQUIL reactions are not integrated in the batch reactor, held constant: {self._equil}")
+
+    def _namespace(self, C, coefficients, hydraulics=None):
+        env = {'_f_' + name: func for name, func in msx_functions.items()}
+        env.update(self.hydraulics)
+        if hydraulics is not None:
+            env.update(hydraulics)
+        env.update(self.coefficients)
+        if coefficients is not None:
+            env.update(coefficients)
+        for i, name in enumerate(self.species):
+            env[name] = C[i]
+        for name, code in self._terms:
+            env[name] = eval(code, {'__builtins__': {}}, env)
+        return env
+
+    def rates(self, C, coefficients=None, hydraulics=None):
+        '''
+        Reaction rates dC/dt (concentration per rate unit) for concentrations
+        C, an (nspecies, N) array. coefficients and hydraulics override the
+        model/reactor values for this call.
+        '''
+        env = self._namespace(C, coefficients, hydraulics)
+        dC = np.zeros_like(C)
+        for i, code in self._rates:
+            dC[i] = eval(code, {'__builtins__': {}}, env)
+        return dC
+
+    def _apply_formulas(self, C, coefficients, hydraulics=None):
+        if len(self._formulas) > 0:
+            env = self._namespace(C, coefficients, hydraulics)
+            for i, code in self._formulas:
+                C[i] = eval(code, {'__builtins__': {}}, env)
+        return C
+
+    def step(self, C, dt, coefficients=None, hydraulics=None, method='rk4'):
+        '''
+        Advances concentrations C, an (nspecies, N) array, by dt seconds.
+        Used by transport engines that react every segment once per quality
+        step.
+
+        Parameters
+        ----------
+        C : numpy array
+            (nspecies, N) concentrations
+        dt : float
+            seconds
+        coefficients, hydraulics : dictionary, optional
+            per call values, scalars or arrays of length N. The default is None.
+        method : string, optional
+            'rk4', 'euler' or 'rk45' (adaptive sub-steps with the model
+            RTOL/ATOL). The default is 'rk4'.
+
+        Returns
+        -------
+        numpy array, new concentrations
+
+        '''
+        if len(self._rates) == 0:
+            return self._apply_formulas(C, coefficients, hydraulics)
+        f = lambda y: self.rates(y, coefficients, hydraulics)
+        h = dt / self.unit_seconds
+        if method == 'euler':
+            C = C + h * f(C)
+        elif method == 'rk45':
+            t = 0.
+            sub = h
+            while t < h * (1 - 1e-12):
+                sub = min(sub, h - t)
+                C_new, err = _dopri5_step(f, C, sub, self.atol, self.rtol)
+                factor = 0.9 * err ** -0.2 if err > 0 else 5.
+                if err > 1.:
+                    sub = sub * max(0.2, factor)
+                    continue
+                C = C_new
+                t += sub
+                sub = sub * min(5., max(0.2, factor))
+        else:
+            C = _rk4_step(f, C, h)
+        return self._apply_formulas(C, coefficients, hydraulics)
+
+    def integrate(self, duration, initial, coefficients=None, report_step=None, method=None,
+                  dt=None, rtol=None, atol=None, max_steps=1000000):
+        '''
+        Integrates the reactions over time for a batch of initial conditions
+        and coefficient values.
+
+        Parameters
+        ----------
+        duration : float
+            seconds to simulate
+        initial : dictionary
+            species -> initial concentration, scalar or array over the batch
+            (missing species start at 0)
+        coefficients : dictionary, optional
+            coefficient -> value, scalar or array over the batch, overrides
+            the model values. The default is None.
+        report_step : float, optional
+            seconds between reported states. The default is None (model TIMESTEP).
+        method : string, optional
+            'rk4' (fixed step), 'euler' (fixed step) or 'rk45' (adaptive
+            Dormand-Prince with rtol/atol). The default is None, which follows
+            the model SOLVER option (EUL -> euler, RK5/ROS2 -> rk45).
+        dt : float, optional
+            seconds per step for fixed step methods, initial step for rk45.
+            The default is None (model TIMESTEP).
+        rtol, atol : float, optional
+            tolerances for rk45. The default is None (model RTOL/ATOL).
+        max_steps : int, optional
+            limit on internal steps. The default is 1000000.
+
+        Returns
+        -------
+        times : numpy array
+            report times in seconds
+        results : numpy array
+            (time, species, batch) concentrations
+
+        '''
+        if method is None:
+            method = 'euler' if self.solver.startswith('EUL') else 'rk45'
+        if dt is None:
+            dt = self.timestep
+        if report_step is None:
+            report_step = self.timestep
+        rtol = self.rtol if rtol is None else rtol
+        atol = self.atol if atol is None else atol
+
+        ## batch size from every array argument
+        arrays = list(initial.values()) + (list(coefficients.values()) if coefficients is not None else [])
+        arrays += list(self.hydraulics.values())
+        n = int(np.broadcast(*[np.asarray(a) for a in arrays]).size) if len(arrays) > 0 else 1
+        C = np.zeros((len(self.species), n))
+        for name in initial.keys():
+            if name not in self.species:
+                print(f"WARNING: initial value for unknown species {name} ignored")
+                continue
+            C[self.species.index(name)] = initial[name]
+        if coefficients is not None:
+            for name in coefficients.keys():
+                if name not in self.coefficients:
+                    print(f"WARNING: COEFFICIENT {name} is not defined in the model, ignored")
+            coefficients = {name: np.asarray(val, dtype=float) for name, val in coefficients.items()
+                            if name in self.coefficients}
+        C = self._apply_formulas(C, coefficients)
+
+        report_times = np.arange(0., duration + report_step/2., report_step)
+        results = np.empty((len(report_times), len(self.species), n))
+        results[0] = C
+
+        ## integrate in rate units
+        scale = 1. / self.unit_seconds
+        f = lambda y: self.rates(y, coefficients)
+        t = 0.
+        h = dt
+        steps = 0
+        for k in range(1, len(report_times)):
+            t_next = report_times[k]
+            while t < t_next - 1e-9:
+                if steps >= max_steps:
+                    print(f"ERROR: max_steps reached at t = {t} s")
+                    return report_times[:k], results[:k]
+                step = min(h if method == 'rk45' else dt, t_next - t)
+                if method == 'rk45':
+                    C_new, err = _dopri5_step(f, C, step * scale, atol, rtol)
+                    steps += 1
+                    factor = 0.9 * err ** -0.2 if err > 0 else 5.
+                    if err > 1.:
+                        h = step * max(0.2, factor)
+                        continue
+                    h = step * min(5., max(0.2, factor))
+                elif method == 'rk4':
+                    C_new = _rk4_step(f, C, step * scale)
+                    steps += 1
+                else:
+                    C_new = C + step * scale * f(C)
+                    steps += 1
+                C = self._apply_formulas(C_new, coefficients)
+                t += step
+            results[k] = C
+        return report_times, results
+
+
+def _rk4_step(f, y, h):
+    k1 = f(y)
+    k2 = f(y + 0.5*h*k1)
+    k3 = f(y + 0.5*h*k2)
+    k4 = f(y + h*k3)
+    return y + h/6.*(k1 + 2*k2 + 2*k3 + k4)
+
+
+## Dormand-Prince 5(4) tableau
+_dp_a = [[],
+         [1/5],
+         [3/40, 9/40],
+         [44/45, -56/15, 32/9],
+         [19372/6561, -25360/2187, 64448/6561, -212/729],
+         [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656],
+         [35/384, 0, 500/1113, 125/192, -2187/6784, 11/84]]
+_dp_b5 = np.array([35/384, 0, 500/1113, 125/192, -2187/6784, 11/84, 0])
+_dp_b4 = np.array([5179/57600, 0, 7571/16695, 393/640, -92097/339200, 187/2100, 1/40])
+
+
+def _dopri5_step(f, y, h, atol, rtol):
+    ## one Dormand-Prince step, error norm is the worst over all species and batch members
+    k = []
+    for i in range(7):
+        yi = y.copy()
+        for j, a in enumerate(_dp_a[i]):
+            if a != 0:
+                yi += h * a * k[j]
+        k.append(f(yi))
+    y5 = y + h * sum(b * ki for b, ki in zip(_dp_b5, k) if b != 0)
+    y4 = y + h * sum(b * ki for b, ki in zip(_dp_b4, k) if b != 0)
+    scale = atol + rtol * np.maximum(np.abs(y), np.abs(y5))
+    err = float(np.max(np.abs(y5 - y4) / scale)) if y.size > 0 else 0.
+    return y5, err
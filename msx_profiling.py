@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""
+PHASE TIMING AND PROFILING FOR THE MSX_TOOLS PIPELINE
+
+msx_tools marks its phases with named spans:
+    msx_parse   reading an .msx file (MSXobj(file_name=...))
+    msx_build   MSXobj.build_msx_file
+    validate    MSXobj.validate
+    engine      EPANET-MSX engine run (run_msx, run_msx_batch)
+    bin_read    MSXBinReader
+    rpt_read    read_msx_rpt
+    wntr_model  WNTR WaterNetworkModel construction (msx_engine)
+    hydraulics  WNTR/EPANET hydraulic simulation (msx_engine)
+
+Nothing is measured until a collector is registered. Every finished span is
+passed to the collectors as an MSXPhaseRecord: wall and CPU time, bytes read
+and written by this process (plus the output files of engine runs), peak RSS
+of this process and of its finished child processes, and optionally a cProfile
+summary.
+
+Usage:
+    collector = msx_profiling.MSXPhaseCollector(profile_phases=['bin_read'])
+    with msx_profiling.collecting(collector), msx_profiling.tags(campaign='base'):
+        ...
+    collector.breakdown(by=['campaign'])
+
+run_msx_batch(collector=..., campaign=...) also collects the engine spans of
+its worker processes.
+
+Collectors are shared by the whole process. Tags and the span nesting are
+context variables: every thread, and every asyncio task (from the context
+it was created in), nests its spans and sees its tags on its own.
+
+"""
+
+import contextlib
+import contextvars
+import cProfile
+import functools
+import io
+import os
+import pstats
+import sys
+import time
+from collections import namedtuple
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError: ## Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+MSXPhaseRecord = namedtuple('MSXPhaseRecord', ['phase', 'parent', 'tags', 'start', 'wall_time', 'cpu_time',
+                                               'bytes_read', 'bytes_written', 'peak_rss', 'child_peak_rss',
+                                               'profile'])
+
+_collectors = []
+_tags = contextvars.ContextVar('msx_profiling_tags', default={}) ## never changed in place
+_stack = contextvars.ContextVar('msx_profiling_stack', default=()) ## phases of the open spans
+
+
+def _io_counters():
+    ## bytes read/written by this process so far, None if the platform does not tell
+    if psutil is not None:
+        try:
+            counters = psutil.Process().io_counters()
+            return (getattr(counters, 'read_chars', counters.read_bytes),
+                    getattr(counters, 'write_chars', counters.write_bytes))
+        except (AttributeError, psutil.Error):
+            pass
+    try:
+        with open('/proc/self/io') as f:
+            values = dict(line.split(':') for line in f)
+        return int(values['rchar']), int(values['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _peak_rss(who='self'):
+    ## peak resident set size in bytes, None if unknown
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+        ## kilobytes on Linux, bytes on macOS
+        return usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    if psutil is not None and who == 'self':
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss)
+    return None
+
+
+def _profile_text(profiler, lines=30):
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(lines)
+    return out.getvalue()
+
+
+def add_collector(collector):
+    '''
+    Registers a callable that receives every MSXPhaseRecord.
+    '''
+    if collector not in _collectors:
+        _collectors.append(collector)
+
+
+def remove_collector(collector):
+    if collector in _collectors:
+        _collectors.remove(collector)
+
+
+@contextlib.contextmanager
+def collecting(collector):
+    '''
+    Registers collector for the duration of a with block. None does nothing.
+    '''
+    if collector is None:
+        yield None
+        return
+    add_collector(collector)
+    try:
+        yield collector
+    finally:
+        remove_collector(collector)
+
+
+@contextlib.contextmanager
+def tags(**kw):
+    '''
+    Adds tags (e.g. campaign=..., run=...) to the records of all spans in a
+    with block.
+    '''
+    token = _tags.set(dict(_tags.get(), **kw))
+    try:
+        yield
+    finally:
+        _tags.reset(token)
+
+
+@contextlib.contextmanager
+def span(phase, **kw):
+    '''
+    Measures a phase of the pipeline.
+
+    Parameters
+    ----------
+    phase : string
+        phase name
+    **kw :
+        tags of this span only
+
+    Yields
+    ------
+    info : dictionary
+        tags of the record. Instrumented code may add 'bytes_read' and
+        'bytes_written' (e.g. output files of a child process), they are added
+        to the counters of this process.
+
+    '''
+    if not _collectors:
+        yield {}
+        return
+    info = dict(_tags.get(), **kw)
+    stack = _stack.get()
+    parent = stack[-1] if stack else None
+    profiler = None
+    if any(getattr(c, 'wants_profile', lambda p: False)(phase) for c in _collectors):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError: ## another profiler (e.g. an enclosing span) is active
+            profiler = None
+    read0, written0 = _io_counters()
+    start = time.time()
+    t0 = time.perf_counter()
+    c0 = time.process_time()
+    token = _stack.set(stack + (phase,))
+    try:
+        yield info
+    finally:
+        _stack.reset(token)
+        wall_time = time.perf_counter() - t0
+        cpu_time = time.process_time() - c0
+        text = None
+        if profiler is not None:
+            profiler.disable()
+            text = _profile_text(profiler)
+        read1, written1 = _io_counters()
+        extra_read = info.pop('bytes_read', 0)
+        extra_written = info.pop('bytes_written', 0)
+        bytes_read = read1 - read0 + extra_read if read0 is not None else None
+        bytes_written = written1 - written0 + extra_written if written0 is not None else None
+        record = MSXPhaseRecord(phase, parent, info, start, wall_time, cpu_time, bytes_read, bytes_written,
+                                _peak_rss('self'), _peak_rss('children'), text)
+        for collector in list(_collectors):
+            collector(record)
+
+
+def file_bytes(*files):
+    ## total size of the files that exist, for the bytes_written of child processes
+    return sum(os.path.getsize(f) for f in files if f is not None and os.path.exists(f))
+
+
+def timed(phase):
+    '''
+    Decorator, runs the function inside span(phase).
+    '''
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kw):
+            if not _collectors:
+                return func(*args, **kw)
+            with span(phase):
+                return func(*args, **kw)
+        return wrapper
+    return decorate
+
+
+class MSXPhaseCollector():
+    def __init__(self, profile_phases=None, profile_dir=None):
+        '''
+        Keeps the MSXPhaseRecords of all spans.
+
+        Parameters
+        ----------
+        profile_phases : list or bool, optional
+            phases to run under cProfile, True for all. Nested spans are not
+            profiled separately while an enclosing span is. The default is None.
+        profile_dir : string, optional
+            if given, the cProfile summary of every profiled span is also
+            written there as <phase>_<pid>_<n>.txt. The default is None.
+
+        '''
+        self.profile_phases = profile_phases
+        self.profile_dir = profile_dir
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record)
+        if record.profile is not None and self.profile_dir is not None:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            file_name = os.path.join(self.profile_dir, f"{record.phase}_{os.getpid()}_{len(self.records)}.txt")
+            with open(file_name, 'w') as f:
+                f.write(record.profile)
+
+    def wants_profile(self, phase):
+        if self.profile_phases is True:
+            return True
+        return self.profile_phases is not None and phase in self.profile_phases
+
+    def clear(self):
+        self.records = []
+
+    def to_dataframe(self):
+        '''
+        One row per record, tags as columns.
+        '''
+        rows = []
+        for record in self.records:
+            row = record._asdict()
+            row.update(row.pop('tags'))
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+    def breakdown(self, by=None):
+        '''
+        Per-phase totals.
+
+        Parameters
+        ----------
+        by : list, optional
+            tags to group by as well (e.g. ['campaign']). The default is None.
+
+        Returns
+        -------
+        pandas DataFrame
+            count, wall_time (total, mean, max), cpu_time, bytes_read,
+            bytes_written, peak_rss and child_peak_rss (max), and share (wall
+            time of the phase over the wall time of the outermost spans of the
+            group; nested phases are also counted in their parents).
+
+        '''
+        by = list(by) if by is not None else []
+        df = self.to_dataframe()
+        if len(df) == 0:
+            return pd.DataFrame()
+        for tag in by:
+            if tag not in df.columns:
+                df[tag] = None
+        keys = by + ['phase']
+        grouped = df.groupby(keys, dropna=False)
+        out = pd.DataFrame({'count': grouped['wall_time'].count(),
+                            'wall_time': grouped['wall_time'].sum(),
+                            'wall_mean': grouped['wall_time'].mean(),
+                            'wall_max': grouped['wall_time'].max(),
+                            'cpu_time': grouped['cpu_time'].sum(),
+                            'bytes_read': grouped['bytes_read'].sum(min_count=1),
+                            'bytes_written': grouped['bytes_written'].sum(min_count=1),
+                            'peak_rss': grouped['peak_rss'].max(),
+                            'child_peak_rss': grouped['child_peak_rss'].max()})
+        top = df[df['parent'].isna()]
+        if len(by) > 0:
+            totals = top.groupby(by, dropna=False)['wall_time'].sum()
+            out['share'] = out['wall_time'] / totals.reindex(out.index.droplevel('phase')).values
+        else:
+            out['share'] = out['wall_time'] / top['wall_time'].sum()
+        return out
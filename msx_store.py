@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+CHUNKED, COMPRESSED HDF5 STORE FOR EPANET-MSX RESULTS
+
+Converts EPANET-MSX binary output (.bin) into an HDF5 file laid out as
+    /times, /species, /units
+    /node/names, /link/names
+    /node/<species>   (time, nnodes) float32
+    /link/<species>   (time, nlinks) float32
+so that one species at a few elements can be read back without touching the
+rest of the results. '%' and '/' in species names are written as %25 and %2F
+in the dataset names, and species '.' and 'names' as %2E and %6Eames (/species
+keeps the names as they are). Requires h5py.
+
+"""
+
+import numpy as np
+import pandas as pd
+import h5py
+
+from msx_tools import (_inp_names, _read_msx_bin_prolog, _read_msx_bin_epilog, iter_msx_bin,
+                       _select_elements, _time_window_steps, MSXResults)
+
+
+def _dataset_name(specie):
+    ## '/' would create nested groups, '.' and 'names' are taken by the group itself and its IDs
+    name = specie.replace('%', '%25').replace('/', '%2F')
+    return {'.': '%2E', 'names': '%6Eames'}.get(name, name)
+
+
+def msx_bin_to_hdf5(filename, epanetinpfile, h5file, chunk_steps=256, chunk_elements=1024,
+                    compression='gzip', compression_opts=4):
+    '''
+    Converts an EPANET-MSX binary file to an HDF5 store, one report step at a
+    time. Only chunk_steps report steps are held in memory, so files larger
+    than RAM can be converted.
+
+    Parameters
+    ----------
+    filename : string
+        EPANET-MSX binary output file (.bin)
+    epanetinpfile : string or WNTR WaterNetworkModel
+        EPANET INP file used for the simulation, supplies node/link names
+    h5file : string
+        HDF5 file to write, overwritten if it exists
+    chunk_steps : int, optional
+        Number of report steps per HDF5 chunk. The default is 256.
+    chunk_elements : int, optional
+        Number of nodes/links per HDF5 chunk. The default is 1024.
+    compression : string, optional
+        h5py compression filter, 'gzip', 'lzf' or None. The default is 'gzip'.
+    compression_opts : int, optional
+        Compression level for gzip. The default is 4.
+
+    Returns
+    -------
+    h5file : string
+
+    '''
+    node_list, link_list, report_start = _inp_names(epanetinpfile)
+    with open(filename, 'rb') as fin:
+        header = _read_msx_bin_prolog(fin)
+        epilog = _read_msx_bin_epilog(fin)
+    if epilog['magic'] != header['magic']:
+        print(f"ERROR: Magic#s do not match, {filename} not converted")
+        return None
+
+    nnodes = header['nnodes']
+    nlinks = header['nlinks']
+    nspecies = header['nspecies']
+    numreport = epilog['numreport']
+    if len(node_list) != nnodes or len(link_list) != nlinks:
+        print(f"WARNING: INP has {len(node_list)} nodes/{len(link_list)} links, "
+              f"binary file has {nnodes}/{nlinks}")
+
+    if compression != 'gzip':
+        compression_opts = None
+    str_dtype = h5py.string_dtype()
+
+    with h5py.File(h5file, 'w') as h5:
+        for key in ['magic', 'version', 'nnodes', 'nlinks', 'nspecies', 'reportstep']:
+            h5.attrs[key] = header[key]
+        h5.attrs['report_start'] = report_start
+        h5.attrs['numreport'] = numreport
+        h5.attrs['errorcode'] = epilog['errorcode']
+
+        h5.create_dataset('times', data=report_start + np.arange(numreport, dtype=np.int64)*header['reportstep'])
+        h5.create_dataset('species', data=header['species'], dtype=str_dtype)
+        h5.create_dataset('units', data=header['units'], dtype=str_dtype)
+
+        datasets = []
+        for group_name, names, count in [('node', node_list, nnodes), ('link', link_list, nlinks)]:
+            group = h5.create_group(group_name)
+            group.create_dataset('names', data=[str(n) for n in names[:count]], dtype=str_dtype)
+            for specie in header['species']:
+                if count == 0:
+                    datasets.append(None)
+                    continue
+                ## time axis resizable, so chunks may be longer than a short (or empty) run
+                datasets.append(group.create_dataset(_dataset_name(specie), shape=(numreport, count), maxshape=(None, count),
+                                                     dtype=np.float32,
+                                                     chunks=(max(min(chunk_steps, numreport), 1), min(chunk_elements, count)),
+                                                     compression=compression, compression_opts=compression_opts,
+                                                     shuffle=compression is not None))
+
+        ## buffer chunk_steps report steps, then write a full row of chunks for every species
+        buffer = np.empty((chunk_steps, nspecies, nnodes + nlinks), dtype=np.float32)
+
+        def flush(t0, n):
+            for s in range(nspecies):
+                if datasets[s] is not None:
+                    datasets[s][t0:t0+n] = buffer[:n, s, :nnodes]
+                if datasets[nspecies + s] is not None:
+                    datasets[nspecies + s][t0:t0+n] = buffer[:n, s, nnodes:]
+
+        k = 0
+        t0 = 0
+        for t, values in iter_msx_bin(filename, report_start):
+            buffer[k] = values
+            k += 1
+            if k == chunk_steps:
+                flush(t0, k)
+                t0 += k
+                k = 0
+        if k > 0:
+            flush(t0, k)
+
+    print(f"INFO: {filename} converted to {h5file}")
+    return h5file
+
+
+def read_msx_hdf5(h5file, species=None, nodes=None, links=None, time_window=None, as_results=False):
+    '''
+    Reads a subset of an HDF5 store written by msx_bin_to_hdf5. Only the
+    chunks holding the requested species, elements and times are read.
+
+    Selection rules are the same as MSXBinReader: if neither nodes nor links
+    are given, all elements are returned, otherwise only the given ones.
+
+    Parameters
+    ----------
+    h5file : string
+        HDF5 store
+    species : list, optional
+        Species to return. The default is None (all species).
+    nodes : list, optional
+        Node IDs to return. The default is None.
+    links : list, optional
+        Link IDs to return. The default is None.
+    time_window : tuple, optional
+        (start, end) in seconds, inclusive. The default is None (all times).
+    as_results : bool, optional
+        Return an MSXResults object instead of a DataFrame. The default is False.
+
+    Returns
+    -------
+    pandas DataFrame with (type, species, name) MultiIndex columns, or MSXResults
+
+    '''
+    with h5py.File(h5file, 'r') as h5:
+        species_list = [s.decode() if isinstance(s, bytes) else s for s in h5['species'][:]]
+        units = [s.decode() if isinstance(s, bytes) else s for s in h5['units'][:]]
+        node_list = [s.decode() for s in h5['node/names'][:]]
+        link_list = [s.decode() for s in h5['link/names'][:]]
+        times = h5['times'][:]
+
+        species_idx, node_idx, link_idx = _select_elements({'species': species_list,
+                                                            'nnodes': len(node_list),
+                                                            'nlinks': len(link_list)},
+                                                           node_list, link_list, species, nodes, links)
+        t0, t1 = _time_window_steps(time_window, int(h5.attrs['report_start']),
+                                    int(h5.attrs['reportstep']), len(times))
+
+        def read(group, specie, idx, count):
+            if len(idx) == 0:
+                return np.empty((t1-t0, 0), dtype=np.float32)
+            if len(idx) == count:
+                values = h5[group][_dataset_name(specie)][t0:t1]
+                return values[:, idx] if idx != list(range(count)) else values
+            ## h5py needs increasing indices, read sorted then restore the requested order
+            order = np.argsort(idx)
+            sorted_idx = np.asarray(idx)[order]
+            unique_idx, inverse = np.unique(sorted_idx, return_inverse=True)
+            values = h5[group][_dataset_name(specie)][t0:t1, unique_idx.tolist()][:, inverse]
+            out = np.empty_like(values)
+            out[:, order] = values
+            return out
+
+        node_blocks = [read('node', species_list[s], node_idx, len(node_list)) for s in species_idx]
+        link_blocks = [read('link', species_list[s], link_idx, len(link_list)) for s in species_idx]
+
+    times = times[t0:t1]
+    if as_results:
+        data = np.empty((t1-t0, len(species_idx), len(node_idx) + len(link_idx)), dtype=np.float32)
+        for k in range(len(species_idx)):
+            data[:, k, :len(node_idx)] = node_blocks[k]
+            data[:, k, len(node_idx):] = link_blocks[k]
+        return MSXResults(data, times, [species_list[s] for s in species_idx],
+                          [node_list[i] for i in node_idx], [link_list[i] for i in link_idx],
+                          units=[units[s] for s in species_idx])
+
+    selected = [species_list[s] for s in species_idx]
+    names = ['type', 'species', 'name']
+    columns = pd.MultiIndex.from_product([['node'], selected, [node_list[i] for i in node_idx]], names=names)
+    columns = columns.append(pd.MultiIndex.from_product([['link'], selected, [link_list[i] for i in link_idx]], names=names))
+    values = np.hstack(node_blocks + link_blocks) if len(selected) > 0 else np.empty((t1-t0, 0), dtype=np.float32)
+    return pd.DataFrame(values, index=times, columns=columns)
@@ -5,22 +5,272 @@ TOOLS ASSOCIATED WITH RUNNING AND USING EPANET-MSX
 @author: JBurkhar
 """
 
-import wntr
 import numpy as np
 import pandas as pd
 import os
 import subprocess
+import asyncio
+import sys
 import re ## text processing
+import hashlib
+import json
+import glob
+import time
+import itertools
+from collections import namedtuple
 
 from msx_library import msx_dict
+from msx_profiling import span, timed, file_bytes
 
 
 std_options = ['area_units', 'rate_units', 'solver', 'timestep', 'coupling', 
                'rtol', 'atol', 'compiler', 'segments', 'peclet']
 
 file_loc = os.path.abspath(__file__)
-split_file = file_loc.split("\\")
-msx_location = '/'.join(split_file[:-1])
+msx_location = os.path.dirname(file_loc).replace("\\", '/')
+
+
+class _MSXRow(list):
+    ## row of an MSXRowTable kept as a list, in place changes bump the table version
+    __slots__ = ('_table',)
+
+    def _changed(self):
+        table = getattr(self, '_table', None) ## not set yet while unpickling
+        if table is not None:
+            table._version += 1
+
+    def __reduce_ex__(self, protocol):
+        ## rebuilt as a plain row of the table it is unpickled with
+        return (list, (list(self),))
+
+
+def _row_mutator(name):
+    method = getattr(list, name)
+    def mutate(self, *args, **kw):
+        result = method(self, *args, **kw)
+        self._changed()
+        return result
+    mutate.__name__ = name
+    return mutate
+
+
+for _name in ['__setitem__', '__delitem__', '__iadd__', '__imul__', 'append', 'extend', 'insert', 'pop',
+              'remove', 'clear', 'reverse', 'sort']:
+    setattr(_MSXRow, _name, _row_mutator(_name))
+
+
+def _msx_row(table, row):
+    ## list.__init__ only, a python __init__ per row doubles the time to load large files
+    new = _MSXRow(row)
+    new._table = table
+    return new
+
+
+class MSXRowTable():
+    def __init__(self, columns, rows=None):
+        '''
+        Rows of a list section of an MSX file ([SOURCES], [PARAMETERS],
+        [QUALITY]). Behaves like the list of row lists it replaces (append,
+        extend, len, iteration, indexing, item assignment).
+        
+        Rows added one at a time or with extend (add_source, add_parameter,
+        rows read from a file or a library model) are kept as lists and can
+        be changed in place. Rows added in bulk with add_columns (add_sources,
+        add_parameters, add_qualities, hot_start) are stored as column arrays
+        and returned as tuples, they cannot be changed in place.
+
+        Parameters
+        ----------
+        columns : list
+            column names
+        rows : list, optional
+            initial rows. The default is None.
+
+        '''
+        self.columns = list(columns)
+        self._blocks = [] ## ('columns', list of arrays) or ('rows', list of row lists), in order
+        self._token = next(_row_table_tokens)
+        self._version = 0
+        if rows is not None:
+            self.extend(rows)
+
+    def __len__(self):
+        return sum(len(block[0]) if kind == 'columns' else len(block) for kind, block in self._blocks)
+
+    def __iter__(self):
+        for kind, block in self.blocks():
+            if kind == 'columns':
+                yield from zip(*block)
+            else:
+                yield from block
+
+    def _locate(self, i):
+        ## (kind, block, position in block) of row i
+        n = len(self)
+        if i < 0:
+            i += n
+        if i < 0 or i >= n:
+            raise IndexError('MSXRowTable index out of range')
+        for kind, block in self._blocks:
+            size = len(block[0]) if kind == 'columns' else len(block)
+            if i < size:
+                return kind, block, i
+            i -= size
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self)[i]
+        kind, block, i = self._locate(i)
+        if kind == 'rows':
+            return block[i]
+        return tuple(col[i].item() if isinstance(col[i], np.generic) else col[i] for col in block)
+
+    def __setitem__(self, i, row):
+        kind, block, i = self._locate(i)
+        if kind == 'columns':
+            raise TypeError('rows added with add_columns cannot be replaced')
+        block[i] = _msx_row(self, row)
+        self._version += 1
+
+    def __eq__(self, other):
+        return [list(row) for row in self] == [list(row) for row in other]
+
+    def __repr__(self):
+        return repr([list(row) for row in self])
+
+    def __copy__(self):
+        ## rows kept as lists are copied too, each belongs to one table
+        new = MSXRowTable(self.columns)
+        new._blocks = [(kind, list(block) if kind == 'columns' else [_msx_row(new, row) for row in block])
+                       for kind, block in self._blocks]
+        return new
+
+    def __deepcopy__(self, memo):
+        new = MSXRowTable(self.columns)
+        new._blocks = [(kind, [col.copy() for col in block] if kind == 'columns' else [_msx_row(new, row) for row in block])
+                       for kind, block in self._blocks]
+        return new
+
+    def __setstate__(self, state):
+        ## unpickled rows are plain lists, track them again
+        self.__dict__.update(state)
+        self._token = next(_row_table_tokens)
+        self._blocks = [(kind, block if kind == 'columns' else [_msx_row(self, row) for row in block])
+                        for kind, block in self._blocks]
+
+    def _row_block(self):
+        if len(self._blocks) == 0 or self._blocks[-1][0] != 'rows':
+            self._blocks.append(('rows', []))
+        return self._blocks[-1][1]
+
+    def append(self, row):
+        self._row_block().append(_msx_row(self, row))
+        self._version += 1
+
+    def extend(self, rows):
+        self._row_block().extend(_msx_row(self, row) for row in rows)
+        self._version += 1
+
+    def add_columns(self, *values):
+        '''
+        Appends rows given column by column. Each value is an array (all of
+        the same length) or a scalar used for every row.
+        '''
+        if len(values) != len(self.columns):
+            raise ValueError(f"expected {len(self.columns)} columns ({', '.join(self.columns)}), got {len(values)}")
+        lengths = [len(v) for v in values if not np.isscalar(v) and v is not None]
+        n = lengths[0] if lengths else 1
+        if any(length != n for length in lengths):
+            raise ValueError(f"columns have different lengths {lengths}")
+        block = []
+        for name, v in zip(self.columns, values):
+            if np.isscalar(v) or v is None:
+                col = np.empty(n, dtype=object)
+                col[:] = [v]
+            else:
+                col = np.array(v) ## own copy, the block is never changed afterwards
+                ## numbers stay numeric in the value column, IDs and names are text
+                if name != 'value' or col.dtype.kind not in 'fiub':
+                    col = col.astype(str).astype(object) if col.dtype.kind != 'O' else col
+            block.append(col)
+        self._blocks.append(('columns', block))
+        self._version += 1
+
+    def blocks(self):
+        '''
+        ('columns', list of column lists) and ('rows', list of rows) blocks
+        in order, for bulk formatting.
+        '''
+        for kind, block in self._blocks:
+            yield kind, [col.tolist() for col in block] if kind == 'columns' else block
+
+    def column_lists(self):
+        '''
+        Every column as one python list (short rows are padded with ''),
+        for bulk formatting.
+        '''
+        out = [[] for _ in self.columns]
+        for kind, block in self.blocks():
+            if kind == 'columns':
+                for values, col in zip(out, block):
+                    values.extend(col)
+            else:
+                for row in block:
+                    for i, values in enumerate(out):
+                        values.append(row[i] if i < len(row) else '')
+        return out
+
+    def to_dataframe(self):
+        return pd.DataFrame(dict(zip(self.columns, self.column_lists())), columns=self.columns)
+
+    def fingerprint(self):
+        ## every change bumps the version, in place changes of rows included (_MSXRow)
+        return (self._token, self._version)
+
+    def filtered(self, keep_columns, keep_row):
+        '''
+        New table without some rows. keep_columns(dictionary of column
+        arrays) returns a boolean mask for a column block, keep_row(row) is
+        called for the rows kept as lists.
+        '''
+        new = MSXRowTable(self.columns)
+        for kind, block in self._blocks:
+            if kind == 'columns':
+                mask = np.asarray(keep_columns(dict(zip(self.columns, block))), dtype=bool)
+                if mask.any():
+                    new._blocks.append(('columns', [col[mask] for col in block]))
+            else:
+                rows = [_msx_row(new, row) for row in block if keep_row(row)]
+                if rows:
+                    new._blocks.append(('rows', rows))
+        return new
+
+
+def _columns_from(data, columns, args):
+    ## bulk add_* arguments: a DataFrame/dict with the named columns, or one value/array per column
+    if hasattr(data, 'columns') or isinstance(data, dict):
+        missing = [c for c in columns if c not in data and args.get(c) is None]
+        if missing:
+            raise ValueError(f"missing columns {missing}")
+        return [np.asarray(data[c]) if c in data else args[c] for c in columns]
+    missing = [c for c in columns[1:] if args[c] is None]
+    if missing:
+        raise ValueError(f"missing columns {missing}")
+    return [data] + [args[c] for c in columns[1:]]
+
+
+_row_table_tokens = itertools.count()
+
+
+def _round_significant(values, digits=7):
+    ## float32 results to the shortest decimals that keep their precision
+    values = np.asarray(values, dtype=np.float64)
+    out = values.copy()
+    nonzero = np.isfinite(values) & (values != 0)
+    exponent = np.floor(np.log10(np.abs(values[nonzero])))
+    scale = 10.**(digits - 1 - exponent)
+    out[nonzero] = np.round(values[nonzero] * scale) / scale
+    return out
 
 
 class MSXobj():
@@ -40,6 +290,11 @@ class MSXobj():
         rate_units = SEC, [MIN], HR  : rate units
         solver     = [RK5], ROS2, EUL: solver to use
         timestep   = number of seconds for the timestep [INT, default = 1 minute, 60 seconds]
+        file_name  = .msx file to read. Values read from a file are typed:
+                     patterns[ID] is a numpy float array, and the value column
+                     of sources, parameters and quality rows is a float (a
+                     column with any non numeric entry stays as strings).
+                     Everything else stays as read (strings).
         Returns
         -------
         None.
@@ -87,7 +342,7 @@ class MSXobj():
         self.terms = {}
         self.pipes = {}
         self.tanks = {}
-        self.sources = [] 
+        self.sources = [] ## MSXRowTable, see the properties below
         self.parameters = []
         self.quality = [] 
         self.patterns = {}
@@ -181,23 +436,21 @@ class MSXobj():
                         item.append('')
                     elif len(item) == 5: ## adds empty for note
                         item.append('')
-                    self.sources.append(item)
+                self.sources.extend(self.msx_info_dict['sources'])
             
             if 'dispersion' in key_list:
                 for key in self.msx_info_dict['dispersion'].keys():
                     self.dispersion[key] = self.msx_info_dict['dispersion'][key]
             
             if 'parameters' in key_list:
-                for item in self.msx_info_dict['parameters']:
-                    self.parameters.append(item)
+                self.parameters.extend(self.msx_info_dict['parameters'])
             
             if 'quality' in key_list:
-                #### TODO: NEEDS TO HANDLE type NODE/LINK SPECIES VALUE ; NOTE STYLE
-
+                ## GLOBAL species value ; note  or  NODE/LINK ID species value ; note
                 for item in self.msx_info_dict['quality']:
                     if len(item) == 3: ## add empty note if missing
                         item.append('')
-                    self.quality.append(item)
+                self.quality.extend(self.msx_info_dict['quality'])
             
             if 'patterns' in key_list:
                 for key in self.msx_info_dict['patterns'].keys():
@@ -211,6 +464,21 @@ class MSXobj():
 #   #################################### FUNCTIONS ############################    
 # =============================================================================
         
+    ## [SOURCES], [PARAMETERS] and [QUALITY] rows are MSXRowTables, assigning a
+    ## plain list of rows wraps it
+    _row_table_columns = {'sources': ['source_type', 'node_ID', 'species', 'value', 'pattern', 'note'],
+                          'parameters': ['loc_type', 'ID', 'coeff_name', 'value', 'note'],
+                          'quality': ['loc_type', 'ID', 'species', 'value', 'note']}
+    
+    def _set_rows(self, section, rows):
+        if not isinstance(rows, MSXRowTable):
+            rows = MSXRowTable(self._row_table_columns[section], rows)
+        self.__dict__['_' + section] = rows
+    
+    sources = property(lambda self: self._sources, lambda self, rows: self._set_rows('sources', rows))
+    parameters = property(lambda self: self._parameters, lambda self, rows: self._set_rows('parameters', rows))
+    quality = property(lambda self: self._quality, lambda self, rows: self._set_rows('quality', rows))
+        
     def add_species(self, species_name, units, note='', loc_type='BULK' ):
         if species_name in self.species.keys():
             print(f"WARNING: SPECIES: Adding {species_name} again, new data will overwite previous values.")
@@ -260,6 +528,25 @@ class MSXobj():
     def add_source(self, source_type, node_ID, species, value, pattern='', note=''):
         self.sources.append([source_type, node_ID, species, value, pattern, note])
         
+    def add_sources(self, source_type, node_ID=None, species=None, value=None, pattern='', note=''):
+        '''
+        Adds many sources at once, stored as columns.
+
+        Parameters
+        ----------
+        source_type : string, array or DataFrame
+            CONCEN, MASS, SETPOINT or FLOWPACED, one per source or one for
+            all. A DataFrame (or dictionary) with columns source_type,
+            node_ID, species, value and optionally pattern and note supplies
+            all of them.
+        node_ID, species, value, pattern, note : array or scalar, optional
+            one entry per source, or one value for all sources
+
+        '''
+        self.sources.add_columns(*_columns_from(source_type, self.sources.columns, 
+                                                {'node_ID': node_ID, 'species': species, 'value': value,
+                                                 'pattern': pattern, 'note': note}))
+        
     def add_dispersion (self, species, value, extra='', note=''):
         self.dispersion[species] = {'val': value,
                                     'extra': extra,
@@ -268,15 +555,229 @@ class MSXobj():
     def add_parameter(self, loc_type, ID, coeff_name, value, note=''):
         self.parameters.append([loc_type, ID, coeff_name, value, note])
     
+    def add_parameters(self, loc_type, ID=None, coeff_name=None, value=None, note=''):
+        '''
+        Assigns PARAMETER coefficient values to many pipes or tanks at once
+        (e.g. one value per pipe from its age or material), stored as columns.
+
+        Parameters
+        ----------
+        loc_type : string, array or DataFrame
+            PIPE or TANK, one per row or one for all. A DataFrame (or 
+            dictionary) with columns loc_type, ID, coeff_name, value and
+            optionally note supplies all of them.
+        ID : array, optional
+            pipe or tank IDs
+        coeff_name : array or string, optional
+            coefficient name(s)
+        value : array or float, optional
+            coefficient values
+        note : array or string, optional
+            The default is ''.
+
+        '''
+        self.parameters.add_columns(*_columns_from(loc_type, self.parameters.columns,
+                                                   {'ID': ID, 'coeff_name': coeff_name, 'value': value,
+                                                    'note': note}))
+    
     def add_quality(self, loc_type, species, value, note=''):
         self.quality.append([loc_type, species, value, note])
         
+    def add_qualities(self, loc_type, ID=None, species=None, value=None, note=''):
+        '''
+        Adds many NODE/LINK initial quality rows at once, stored as columns.
+
+        Parameters
+        ----------
+        loc_type : string, array or DataFrame
+            NODE or LINK, one per row or one for all. A DataFrame (or
+            dictionary) with columns loc_type, ID, species, value and
+            optionally note supplies all of them.
+        ID, species, value, note : array or scalar, optional
+            one entry per row, or one value for all rows
+
+        '''
+        self.quality.add_columns(*_columns_from(loc_type, self.quality.columns,
+                                                {'ID': ID, 'species': species, 'value': value, 'note': note}))
+    
+    def hot_start(self, binfile, epanetinpfile, step=-1, species=None, threshold=0.0, nodes=True, 
+                  links=True, replace=True):
+        '''
+        Sets the initial quality of every node and link from one report step
+        of a previous run (e.g. the end of a spin-up run), as NODE/LINK
+        [QUALITY] rows for every species. The new run starts from that state
+        at time 0 of its own INP file.
+
+        Parameters
+        ----------
+        binfile : string
+            EPANET-MSX binary output file of the previous run
+        epanetinpfile : string or WNTR WaterNetworkModel
+            EPANET INP file of the previous run (same network), supplies the
+            node/link IDs
+        step : int, optional
+            report step to use, negative counts from the end. The default is
+            -1 (last step).
+        species : list, optional
+            species to set. The default is None (every species of the binary
+            file that is defined in this model).
+        threshold : float, optional
+            values with an absolute value at or below threshold are not
+            written (they start at 0). The default is 0.0.
+        nodes : bool, optional
+            set node quality. The default is True.
+        links : bool, optional
+            set link quality. The default is True.
+        replace : bool, optional
+            remove the existing [QUALITY] rows of these species first (GLOBAL
+            rows only if both nodes and links are set). Species that keep a
+            GLOBAL row are written without the threshold, omitted elements
+            would start at the GLOBAL value. The default is True.
+
+        Returns
+        -------
+        int
+            number of [QUALITY] rows added
+
+        '''
+        node_list, link_list, report_start = _inp_names(epanetinpfile)
+        with open(binfile, 'rb') as fin:
+            header = _read_msx_bin_prolog(fin)
+            epilog = _read_msx_bin_epilog(fin)
+        if epilog['magic'] != header['magic']:
+            print(f"ERROR: {binfile} is incomplete (Magic#s do not match), initial quality not changed")
+            return 0
+        nnodes, nlinks, nspecies = header['nnodes'], header['nlinks'], header['nspecies']
+        if nnodes != len(node_list) or nlinks != len(link_list):
+            print(f"ERROR: {binfile} does not match the network of {epanetinpfile}, initial quality not changed")
+            return 0
+        numreport = epilog['numreport']
+        k = step + numreport if step < 0 else step
+        if k < 0 or k >= numreport:
+            print(f"ERROR: report step {step} not in {binfile} ({numreport} steps)")
+            return 0
+        
+        if species is None:
+            species = [sp for sp in header['species'] if sp in self.species.keys()]
+            for sp in header['species']:
+                if sp not in self.species.keys():
+                    print(f"WARNING: QUALITY: {sp} is not defined in the model, not set")
+        else:
+            for sp in species:
+                if sp not in header['species']:
+                    print(f"WARNING: QUALITY: {sp} is not in {binfile}, not set")
+            species = [sp for sp in species if sp in header['species']]
+        if len(species) == 0:
+            return 0
+        
+        values = np.array(_msx_bin_memmap(binfile, header, numreport)[k], dtype=np.float64)
+        element_values = {'NODE': values[:nspecies*nnodes].reshape(nspecies, nnodes),
+                          'LINK': values[nspecies*nnodes:].reshape(nspecies, nlinks)}
+        names = {'NODE': np.array(node_list, dtype=object), 'LINK': np.array(link_list, dtype=object)}
+        loc_types = [loc for loc, use in [('NODE', nodes), ('LINK', links)] if use]
+        
+        if replace:
+            hot = set(species)
+            drop = set(loc_types) | ({'GLOBAL'} if len(loc_types) == 2 else set())
+            def keep_row(row):
+                loc = str(row[0]).upper()
+                name = row[1] if loc == 'GLOBAL' else (row[2] if len(row) > 2 else None)
+                return not (loc in drop and name in hot)
+            self.quality = self.quality.filtered(
+                lambda cols: ~(np.isin(cols['species'], list(hot)) & 
+                               np.isin(np.char.upper(cols['loc_type'].astype(str)), list(drop))),
+                keep_row)
+        with_global = set(row[1] for row in self.quality if str(row[0]).upper() == 'GLOBAL')
+        
+        added = 0
+        for loc in loc_types:
+            ids, sps, vals = [], [], []
+            for sp in species:
+                v = element_values[loc][header['species'].index(sp)]
+                keep = np.abs(v) > threshold if sp not in with_global else np.ones(len(v), dtype=bool)
+                ids.append(names[loc][keep])
+                sps.append(np.full(keep.sum(), sp, dtype=object))
+                vals.append(v[keep])
+            ids = np.concatenate(ids)
+            if len(ids) == 0:
+                continue
+            self.quality.add_columns(loc, ids, np.concatenate(sps), 
+                                     _round_significant(np.concatenate(vals)), '')
+            added += len(ids)
+        print(f"INFO: QUALITY: {added} initial values from report step {k} of {binfile}")
+        return added
+    
     def add_pattern(self, pattern_ID, pattern):
         if pattern_ID in self.patterns.keys():
             print(f"WARNING: PATTERNS: {pattern_ID} already defined, new data will overwrite previous values")
         self.patterns[pattern_ID] = pattern
     
     
+    def pattern_compaction(self):
+        '''
+        Finds how much the patterns can be coarsened without changing them.
+        A pattern that is constant over blocks of k values (and whose length
+        is a multiple of k) is reproduced exactly with every k-th value and a
+        pattern timestep k times longer.
+
+        Returns
+        -------
+        factor : int
+            largest k valid for all patterns together (patterns share the INP
+            PATTERN TIMESTEP)
+        per_pattern : dictionary
+            pattern ID -> largest k for that pattern
+
+        '''
+        per_pattern = {key: _pattern_compaction_factor(self.patterns[key]) for key in self.patterns.keys()}
+        factor = int(np.gcd.reduce(list(per_pattern.values()))) if len(per_pattern) > 0 else 1
+        return factor, per_pattern
+    
+    def compact_patterns(self, inpfile=None, new_inpfile=None):
+        '''
+        Rewrites the patterns at the coarsest pattern timestep that reproduces
+        them exactly. MSX patterns use the PATTERN TIMESTEP of the EPANET INP
+        file, so the INP demand patterns must allow the same factor; with 
+        inpfile and new_inpfile the INP file is rewritten to match 
+        (see compact_inp_patterns). Without an INP file the patterns are only
+        compacted if the INP PATTERN TIMESTEP is changed by hand.
+
+        Parameters
+        ----------
+        inpfile : string, optional
+            EPANET INP file used with this model. The default is None.
+        new_inpfile : string, optional
+            where to write the adjusted INP file. The default is None.
+
+        Returns
+        -------
+        factor : int
+            factor applied to the patterns and the PATTERN TIMESTEP, 1 if nothing changed
+
+        '''
+        factor, per_pattern = self.pattern_compaction()
+        if inpfile is not None:
+            inp_factor = _inp_pattern_compaction_factor(inpfile)
+            factor = int(np.gcd(factor, inp_factor))
+        if factor <= 1:
+            print("INFO: PATTERNS: patterns cannot be compacted")
+            return 1
+        
+        if inpfile is not None:
+            if new_inpfile is None:
+                print("ERROR: PATTERNS: new_inpfile is required to adjust the INP PATTERN TIMESTEP")
+                return 1
+            if not compact_inp_patterns(inpfile, factor, new_inpfile):
+                return 1
+        else:
+            print(f"WARNING: PATTERNS: multiply the INP PATTERN TIMESTEP by {factor} to use the compacted patterns")
+        
+        before = sum(len(self.patterns[key]) for key in self.patterns.keys())
+        for key in self.patterns.keys():
+            self.patterns[key] = self.patterns[key][::factor]
+        print(f"INFO: PATTERNS: {before} pattern values reduced to {before // factor}")
+        return factor
+    
     def add_report_type(self, loc, value):
         self.report.append([loc, value])
     
@@ -285,164 +786,1170 @@ class MSXobj():
     
     def _available_species(self):
         print(list(self.species.keys()))
-    
+
+    def batch_reactor(self, location='pipes', hydraulics=None):
+        '''
+        Compiles the terms, coefficients and pipe (or tank) reactions into
+        vectorized NumPy rate functions for batch reactor screening, see
+        msx_kinetics.BatchReactor.integrate.
+
+        Parameters
+        ----------
+        location : string, optional
+            'pipes' or 'tanks'. The default is 'pipes'.
+        hydraulics : dictionary, optional
+            values of D, Q, U, Re, Us, Ff, Av, Kc, Len, scalars or arrays.
+            The default is None (all 0).
+
+        Returns
+        -------
+        msx_kinetics.BatchReactor
+
+        '''
+        from msx_kinetics import BatchReactor
+        return BatchReactor(self, location=location, hydraulics=hydraulics)
+
+    @timed('validate')
+    def validate(self, inpfile=None, verbose=True):
+        '''
+        Pre-flight check of the model before an engine run: parses every
+        term/pipe/tank expression, checks names against species, coefficients,
+        terms and hydraulic variables, looks for term cycles, and (with an INP
+        file) checks the node/link IDs used by sources, parameters, quality
+        and report. Also lists terms and species that do not affect any
+        reported species.
+
+        Parameters
+        ----------
+        inpfile : string, optional
+            EPANET INP file for element ID checks. The default is None (no ID checks).
+        verbose : bool, optional
+            print the errors and warnings. The default is True.
+
+        Returns
+        -------
+        dictionary
+            'errors', 'warnings' (lists of strings), 'unused_terms',
+            'unused_species' (lists of names). The model can run if
+            'errors' is empty.
+
+        '''
+        from msx_kinetics import parse_expression, expression_names, term_order, hydraulic_variables
+        errors = []
+        warnings = []
+
+        lookup = {}
+        for group in [hydraulic_variables, self.coefficients.keys(), self.terms.keys(), self.species.keys()]:
+            for name in group:
+                lookup[name.lower()] = name
+        species_lower = {name.lower(): name for name in self.species.keys()}
+
+        for name in self.coefficients.keys():
+            try:
+                float(self.coefficients[name]['val'])
+            except (TypeError, ValueError):
+                errors.append(f"COEFFICIENTS: {name} value {self.coefficients[name]['val']} is not a number")
+
+        ## every expression -> the names it uses, undefined names are errors
+        uses = {}
+        for section, items in [('TERMS', self.terms), ('PIPES', self.pipes), ('TANKS', self.tanks)]:
+            for name in items.keys():
+                key = name if section == 'TERMS' else (section, name)
+                uses[key] = set()
+                if section != 'TERMS':
+                    if name.lower() not in species_lower:
+                        errors.append(f"{section}: reaction for undefined species {name}")
+                    if str(items[name]['type']).upper() not in ['RATE', 'FORMULA', 'EQUIL']:
+                        errors.append(f"{section}: {name} has unknown expression type {items[name]['type']}")
+                try:
+                    tree = parse_expression(items[name]['val'])
+                except ValueError as e:
+                    errors.append(f"{section}: {name}: {e}")
+                    continue
+                for ref in expression_names(tree):
+                    if ref.lower() not in lookup:
+                        errors.append(f"{section}: {name} uses undefined name {ref}")
+                    else:
+                        uses[key].add(lookup[ref.lower()])
+
+        try:
+            term_order({name: self.terms[name]['val'] for name in self.terms.keys()}, lookup)
+        except ValueError as e:
+            errors.append(f"TERMS: {e}")
+
+        for name in self.species.keys():
+            if name not in self.pipes.keys():
+                warnings.append(f"PIPES: no reaction for species {name}")
+            if str(self.species[name]['type']).upper() not in ['BULK', 'WALL']:
+                errors.append(f"SPECIES: {name} has unknown type {self.species[name]['type']}")
+
+        ## element IDs
+        nodes = links = None
+        if inpfile is not None:
+            index = read_inp_index(inpfile)
+            nodes = set(index['nodes'])
+            links = set(index['links'])
+
+        def check_id(section, loc, ID):
+            if nodes is None:
+                return
+            if loc in ['NODE', 'TANK', 'NODES'] and ID not in nodes:
+                errors.append(f"{section}: node {ID} is not in the INP file")
+            elif loc in ['LINK', 'PIPE', 'LINKS'] and ID not in links:
+                errors.append(f"{section}: link {ID} is not in the INP file")
+
+        def check_species(section, name):
+            if str(name).lower() not in species_lower:
+                errors.append(f"{section}: undefined species {name}")
+
+        for item in self.sources:
+            if str(item[0]).upper() not in ['CONCEN', 'MASS', 'SETPOINT', 'FLOWPACED']:
+                errors.append(f"SOURCES: unknown source type {item[0]}")
+            check_id('SOURCES', 'NODE', item[1])
+            check_species('SOURCES', item[2])
+            if len(item) > 4 and item[4] not in ['', None] and item[4] not in self.patterns.keys():
+                errors.append(f"SOURCES: pattern {item[4]} is not defined")
+
+        for item in self.parameters:
+            loc = str(item[0]).upper()
+            if loc not in ['PIPE', 'TANK']:
+                errors.append(f"PARAMETERS: unknown location type {item[0]}")
+            check_id('PARAMETERS', loc, item[1])
+            if item[2] not in self.coefficients.keys():
+                errors.append(f"PARAMETERS: undefined coefficient {item[2]}")
+            elif str(self.coefficients[item[2]]['type']).upper() != 'PARAMETER':
+                warnings.append(f"PARAMETERS: {item[2]} is a {self.coefficients[item[2]]['type']}, not a PARAMETER")
+
+        for item in self.quality:
+            loc = str(item[0]).upper()
+            if loc == 'GLOBAL':
+                check_species('QUALITY', item[1])
+            elif loc in ['NODE', 'LINK']:
+                check_id('QUALITY', loc, item[1])
+                check_species('QUALITY', item[2])
+            else:
+                errors.append(f"QUALITY: unknown location type {item[0]}")
+
+        reported = []
+        for item in self.report:
+            if len(item) < 2:
+                continue
+            loc = str(item[0]).upper()
+            if loc in ['NODES', 'LINKS']:
+                for ID in item[1:]:
+                    if str(ID).upper() != 'ALL':
+                        check_id('REPORT', loc, ID)
+            elif loc in ['SPECIE', 'SPECIES']:
+                check_species('REPORT', item[1])
+                if len(item) < 3 or str(item[2]).upper() == 'YES':
+                    reported.append(species_lower.get(str(item[1]).lower(), item[1]))
+
+        for pattern in self.patterns.keys():
+            if len(self.patterns[pattern]) == 0:
+                warnings.append(f"PATTERNS: {pattern} is empty")
+
+        ## terms and species reached from the reported species (all species if none listed)
+        if len(reported) == 0:
+            reported = list(self.species.keys())
+        needed = set()
+        todo = list(reported)
+        while len(todo) > 0:
+            name = todo.pop()
+            if name in needed:
+                continue
+            needed.add(name)
+            if name in self.terms.keys():
+                todo += list(uses.get(name, []))
+            else:
+                todo += list(uses.get(('PIPES', name), [])) + list(uses.get(('TANKS', name), []))
+        unused_terms = [name for name in self.terms.keys() if name not in needed]
+        unused_species = [name for name in self.species.keys() if name not in needed]
+        for name in unused_terms:
+            warnings.append(f"TERMS: {name} does not affect any reported species")
+        for name in unused_species:
+            warnings.append(f"SPECIES: {name} does not affect any reported species")
+
+        if verbose:
+            for text in errors:
+                print(f"ERROR: {text}")
+            for text in warnings:
+                print(f"WARNING: {text}")
+        return {'errors': errors,
+                'warnings': warnings,
+                'unused_terms': unused_terms,
+                'unused_species': unused_species}
+
+    @timed('msx_build')
     def build_msx_file(self, file_name='temp.msx', style='MSX2'):
         '''
-        
+        Writes the MSX file section by section. The text of every section is
+        cached and only re-rendered when the section's contents changed since
+        the previous build (e.g. during a sweep only [COEFFICIENTS] changes).
 
         Parameters
         ----------
-        file_name : string, filename, optional
-            DESCRIPTION. The default is 'temp.msx'.
+        file_name : string or open file handle, optional
+            File to write. The default is 'temp.msx'.
         style : string, [MSX2 or MSX11], optional
-            DESCRIPTION. The default is 'MSX2'.
+            MSX file format version. The default is 'MSX2'.
 
         Returns
         -------
         None.
 
         '''
-        file_string = '[TITLE]\n'
-        file_string += self.title + '\n'*2
-        
-        file_string += '[OPTIONS]\n'
-        for key in self.options.keys():
-            skip = False
-            if style != 'MSX2':
-                if key in ['peclet', 'segments', ]:
-                    skip = True
-            
-            if not skip:
-                lval = len(key)
-                file_string += f"  {key.upper()}{' '*(11-lval)}{self.options[key]['val']} \t\t\t;{self.options[key]['note']}\n"
-        
-        file_string += '\n[SPECIES]\n'
-        for key in self.species.keys():
-            lval = len(key)
-            file_string += f"  {self.species[key]['type'].upper()} {key}{' '*(11-lval)}{self.species[key]['val']}\t\t\t;{self.species[key]['note']}\n"
+        if not hasattr(self, '_section_cache'):
+            self._section_cache = {}
         
-        file_string += '\n[COEFFICIENTS]\n'
-        for key in self.coefficients.keys():
-            lval = len(key)
-            file_string += f"  {self.coefficients[key]['type'].upper()} {key}{' '*(11-lval)}{self.coefficients[key]['val']}\t\t\t;{self.coefficients[key]['note']}\n"
+        sections = ['title', 'options', 'species', 'coefficients', 'terms', 'pipes', 'tanks', 'sources']
+        if style == 'MSX2':
+            sections.append('diffusivity')
+        sections += ['parameters', 'quality', 'patterns', 'report']
         
-        file_string += '\n[TERMS]\n'
-        for key in self.terms.keys():
-            file_string += f"  {key}\t\t{self.terms[key]['val']}\t\t\t;{self.terms[key]['note']}\n"
+        if hasattr(file_name, 'write'):
+            f = file_name
+        else:
+            f = open(file_name, 'w')
+        for section in sections:
+            fingerprint = self._section_fingerprint(section, style)
+            cached = self._section_cache.get(section)
+            if cached is None or cached[0] != fingerprint:
+                cached = (fingerprint, self._render_section(section, style))
+                self._section_cache[section] = cached
+            f.write(cached[1])
+        if f is not file_name:
+            f.close()
+        print(f"INFO: MSX FILE {file_name} generated.")
+    
+    def _section_fingerprint(self, section, style):
+        ## cheap summary of everything a section's text depends on
+        if section == 'title':
+            return self.title
+        elif section == 'options':
+            return (style, repr(self.options))
+        elif section == 'diffusivity':
+            return (repr(list(self.species.keys())), repr(self.dispersion))
+        elif section == 'patterns':
+            return tuple((key, _pattern_fingerprint(self.patterns[key])) for key in self.patterns.keys())
+        elif isinstance(getattr(self, section), MSXRowTable):
+            return getattr(self, section).fingerprint()
+        return repr(getattr(self, section))
+    
+    def _render_section(self, section, style):
+        ## text of one section, including the blank line separating it from the previous one
+        lines = []
+        if section == 'title':
+            return '[TITLE]\n' + self.title + '\n'*2
         
-        file_string += '\n[PIPES]\n'
-        for key in self.pipes.keys():
-            file_string += f"  {self.pipes[key]['type'].upper()}\t{key}\t\t{self.pipes[key]['val']}\t\t\t;{self.pipes[key]['note']}\n"
+        elif section == 'options':
+            lines.append('[OPTIONS]\n')
+            for key in self.options.keys():
+                skip = False
+                if style != 'MSX2':
+                    if key in ['peclet', 'segments', ]:
+                        skip = True
+                
+                if not skip:
+                    lval = len(key)
+                    lines.append(f"  {key.upper()}{' '*(11-lval)}{self.options[key]['val']} \t\t\t;{self.options[key]['note']}\n")
         
+        elif section in ['species', 'coefficients']:
+            items = getattr(self, section)
+            lines.append(f'\n[{section.upper()}]\n')
+            for key in items.keys():
+                lval = len(key)
+                lines.append(f"  {items[key]['type'].upper()} {key}{' '*(11-lval)}{items[key]['val']}\t\t\t;{items[key]['note']}\n")
         
-        file_string += '\n[TANKS]\n'
-        for key in self.tanks.keys():
-            file_string += f"  {self.tanks[key]['type'].upper()}\t{key}\t\t{self.tanks[key]['val']}\t\t\t;{self.tanks[key]['note']}\n"
+        elif section == 'terms':
+            lines.append('\n[TERMS]\n')
+            for key in self.terms.keys():
+                lines.append(f"  {key}\t\t{self.terms[key]['val']}\t\t\t;{self.terms[key]['note']}\n")
         
+        elif section in ['pipes', 'tanks']:
+            items = getattr(self, section)
+            lines.append(f'\n[{section.upper()}]\n')
+            for key in items.keys():
+                lines.append(f"  {items[key]['type'].upper()}\t{key}\t\t{items[key]['val']}\t\t\t;{items[key]['note']}\n")
         
-        file_string += '\n[SOURCES]\n'
-        for item in self.sources:
-            file_string += f"  {item[0].upper()}\t{item[1]}\t\t\t\t{item[2]}\t\t{item[3]}\t\t\t{item[4]}\t\t\t;{item[5]}\n"
+        elif section == 'sources':
+            lines.append('\n[SOURCES]\n')
+            lines += [f"  {source_type.upper()}\t{ID}\t\t\t\t{species}\t\t{value}\t\t\t{pattern}\t\t\t;{note}\n"
+                      for source_type, ID, species, value, pattern, note in zip(*self.sources.column_lists())]
         
-        if style == 'MSX2':
-            file_string += '\n[DIFFUSIVITY]\n'
+        elif section == 'diffusivity':
+            lines.append('\n[DIFFUSIVITY]\n')
             for key in self.species.keys():
                 if key not in self.dispersion.keys():
-                    file_string += f"  {key}\t1.0\n"
+                    lines.append(f"  {key}\t1.0\n")
                 else:
-                    file_string += f"  {key}\t{self.dispersion[key]['val']}\t\t{self.dispersion[key]['extra']}\t\t\t;{self.dispersion[key]['note']}\n"
+                    lines.append(f"  {key}\t{self.dispersion[key]['val']}\t\t{self.dispersion[key]['extra']}\t\t\t;{self.dispersion[key]['note']}\n")
         
-        file_string += '\n[PARAMETERS]\n'
-        for item in self.parameters:
-            file_string += f"  {item[0].upper()}\t{item[1]}\t\t\t\t{item[2]}\t\t\t{item[3]}\t\t\t;{item[4]}\n"
+        elif section == 'parameters':
+            lines.append('\n[PARAMETERS]\n')
+            lines += [f"  {loc_type.upper()}\t{ID}\t\t\t\t{coeff_name}\t\t\t{value}\t\t\t;{note}\n"
+                      for loc_type, ID, coeff_name, value, note in zip(*self.parameters.column_lists())]
+        
+        elif section == 'quality':
+            lines.append('\n[QUALITY]\n')
+            for kind, block in self.quality.blocks():
+                if kind == 'columns':
+                    ## NODE/LINK rows added in bulk (add_qualities, hot_start)
+                    lines += [f"  {loc_type.upper()}\t{ID}\t\t\t\t{species}\t\t{value}\t\t\t;{note}\n"
+                              for loc_type, ID, species, value, note in zip(*block)]
+                    continue
+                for item in block:
+                    if str(item[0]).upper() == 'GLOBAL' or len(item) < 5:
+                        lines.append(f"  {item[0].upper()}\t{item[1]}\t\t\t\t{item[2]}\t\t\t;{item[3] if len(item) > 3 else ''}\n")
+                    else:
+                        lines.append(f"  {item[0].upper()}\t{item[1]}\t\t\t\t{item[2]}\t\t{item[3]}\t\t\t;{item[4]}\n")
+        
+        elif section == 'patterns':
+            if not getattr(self, '_pattern_hint_shown', False):
+                ## once per object, not on every build
+                factor, per_pattern = self.pattern_compaction()
+                if factor > 1:
+                    total = sum(len(self.patterns[key]) for key in self.patterns.keys())
+                    print(f"WARNING: PATTERNS: patterns are constant over every {factor} pattern timesteps, "
+                          f"compact_patterns() would reduce {total} values to {total // factor}")
+                    self._pattern_hint_shown = True
+            lines.append('\n[PATTERNS]')
+            for key in self.patterns.keys():
+                ## 10 values per line, formatted in bulk
+                patt_vals = _pattern_strings(self.patterns[key])
+                prefix = f"\n  {key}\t"
+                lines += [prefix + '\t'.join(patt_vals[i:i+10]) for i in range(0, len(patt_vals), 10)]
+        
+        elif section == 'report':
+            lines.append('\n\n[REPORT]\n')
+            for item in self.report:
+                if len(item) > 1:
+                    for sub_item in item:
+                        if item[0] == sub_item:
+                            lines.append(f"  {sub_item.upper()}\t\t")
+                        else:
+                            lines.append(f"{sub_item}\t")
+                    lines.append("\n")
+        
+        return ''.join(lines)
         
         
-        file_string += '\n[QUALITY]\n'
-        for item in self.quality:
-            #### TODO: NEEDS TO HANDLE type NODE/LINK SPECIES VALUE ; NOTE STYLE
-            file_string += f"  {item[0].upper()}\t{item[1]}\t\t\t\t{item[2]}\t\t\t;{item[3]}\n"
 
+class MSXResults():
+    def __init__(self, data, times, species, node_names, link_names, units=None):
+        '''
+        Results of an EPANET-MSX simulation, stored as one contiguous float32
+        array shaped (time, species, element). Elements are the nodes followed
+        by the links, in INP order.
         
-        file_string += '\n[PATTERNS]'
-        for key in self.patterns.keys():
-            patt_vals = self.patterns[key]
-            for i in range(len(patt_vals)):
-                if i % 10 == 0:
-                    file_string += f"\n  {key}\t{patt_vals[i]}"
-                else:
-                    file_string += f"\t{patt_vals[i]}"
+        .node[species] and .link[species] return (time x name) DataFrames that
+        are views on the array. Use to_dataframe() for the (type, species, name)
+        MultiIndex layout returned by MSXBinReader, or to_long() for a long table.
+
+        Parameters
+        ----------
+        data : numpy array
+            (time, species, nnodes+nlinks) concentrations
+        times : list or array
+            report times in seconds
+        species : list
+            species names
+        node_names : list
+            node IDs
+        link_names : list
+            link IDs
+        units : list, optional
+            species units. The default is None.
+
+        '''
+        self.data = np.ascontiguousarray(data, dtype=np.float32)
+        self.times = np.asarray(times)
+        self.species = list(species)
+        self.units = list(units) if units is not None else ['']*len(self.species)
+        self.node_names = np.asarray(node_names, dtype=object)
+        self.link_names = np.asarray(link_names, dtype=object)
+        self.nnodes = len(self.node_names)
+        self.nlinks = len(self.link_names)
         
-        file_string += '\n\n[REPORT]\n'
-        for item in self.report:
-            if len(item) > 1:
-                for sub_item in item:
-                    if item[0] == sub_item:
-                        file_string += f"  {sub_item.upper()}\t\t"
-                    else:
-                        file_string += f"{sub_item}\t"
-                file_string += "\n"
-            # if len(item) == 2:
-            #     file_string += f"  {item[0].upper()}\t\t{item[1]}\n"
-            # else:
-            #     file_string += f"  {item[0].upper()}\t\t{item[1]}\t\t\t{item[2]}\t{item[3]}\n"
-        
-        f = open(file_name, 'w')
-        f.write(file_string)
-        f.close()
-        print(f"INFO: MSX FILE {file_name} generated.")
+        self._species_idx = {name: i for i, name in enumerate(self.species)}
+        self._node_idx = {name: i for i, name in enumerate(self.node_names)}
+        self._link_idx = {name: i for i, name in enumerate(self.link_names)}
         
-        # print(file_string) ## will be replaced with output step later
+        self.node = _MSXElementView(self, 'node')
+        self.link = _MSXElementView(self, 'link')
+    
+    def __repr__(self):
+        return (f"<MSXResults: {len(self.times)} times, {len(self.species)} species, "
+                f"{self.nnodes} nodes, {self.nlinks} links>")
+    
+    def species_index(self, species):
+        return self._species_idx[species]
+    
+    def node_index(self, node_ID):
+        return self._node_idx[str(node_ID)]
+    
+    def link_index(self, link_ID):
+        ## link positions are offset by the number of nodes in the element axis
+        return self.nnodes + self._link_idx[str(link_ID)]
+    
+    def get(self, species, node=None, link=None):
+        '''
+        Time series for one species at one node or link, as a view on the data.
+        '''
+        if node is not None:
+            return self.data[:, self.species_index(species), self.node_index(node)]
+        return self.data[:, self.species_index(species), self.link_index(link)]
+    
+    def to_dataframe(self):
+        '''
+        Wide DataFrame with (type, species, name) MultiIndex columns, the
+        layout returned by MSXBinReader. Copies the data.
+        '''
+        nn = self.nnodes
+        ntimes = len(self.times)
+        values = np.hstack([self.data[:, :, :nn].reshape(ntimes, -1),
+                            self.data[:, :, nn:].reshape(ntimes, -1)])
+        names = ['type', 'species', 'name']
+        columns = pd.MultiIndex.from_product([['node'], self.species, self.node_names], names=names)
+        columns = columns.append(pd.MultiIndex.from_product([['link'], self.species, self.link_names], names=names))
+        return pd.DataFrame(values, index=self.times, columns=columns)
+    
+    def to_long(self):
+        '''
+        Long DataFrame with time, type, species, name and value columns.
+        type, species and name are categoricals. Copies the data.
+        '''
+        ntimes, nspecies, nelements = self.data.shape
+        element_type = np.repeat(np.array([0, 1], dtype=np.int8), [self.nnodes, self.nlinks])
+        element_names = np.concatenate([self.node_names, self.link_names])
+        name_categories, name_codes = np.unique(element_names.astype(str), return_inverse=True)
+        
+        return pd.DataFrame({
+            'time': np.repeat(self.times, nspecies*nelements),
+            'type': pd.Categorical.from_codes(np.tile(element_type, ntimes*nspecies), ['node', 'link']),
+            'species': pd.Categorical.from_codes(np.tile(np.repeat(np.arange(nspecies), nelements), ntimes), self.species),
+            'name': pd.Categorical.from_codes(np.tile(name_codes, ntimes*nspecies), name_categories),
+            'value': self.data.reshape(-1)})
+
+
+class _MSXElementView():
+    ## supports results.node[species] / results.link[species] on MSXResults
+    def __init__(self, results, element_type):
+        self._results = results
+        self._type = element_type
+    
+    def keys(self):
+        return list(self._results.species)
+    
+    def __getitem__(self, species):
+        res = self._results
+        s = res.species_index(species)
+        if self._type == 'node':
+            values = res.data[:, s, :res.nnodes]
+            names = res.node_names
+        else:
+            values = res.data[:, s, res.nnodes:]
+            names = res.link_names
+        return pd.DataFrame(values, index=res.times, columns=pd.Index(names, name='name'), copy=False)
+        
+
+class MSXBinWriter():
+    def __init__(self, filename, nnodes, nlinks, species, units=None, reportstep=3600, 
+                 version=200000, magic=516114521):
+        '''
+        Writes EPANET-MSX binary output, byte for byte in the engine's layout:
+        prolog (magic, version, counts, report step), species names and units
+        (name/unit pairs for version >= 200000, all names then all units for
+        1.1), the float32 results one report step at a time, and the epilog.
         
+        Steps can be written incrementally with write_step, or all at once
+        with write_steps. close() writes the epilog; when used as a context
+        manager the epilog is only written if no exception occurred, leaving
+        the file as an aborted engine run would.
+
+        Parameters
+        ----------
+        filename : string
+            binary file to write
+        nnodes : int
+            number of nodes
+        nlinks : int
+            number of links
+        species : list
+            species names
+        units : list, optional
+            species units. The default is None ('MG' for every species).
+        reportstep : int, optional
+            report step in seconds. The default is 3600.
+        version : int, optional
+            200000 (MSX 2.x) or 100000 (MSX 1.1). The default is 200000.
+        magic : int, optional
+            magic number. The default is 516114521 (EPANET-MSX).
+
+        '''
+        self.filename = filename
+        self.nnodes = int(nnodes)
+        self.nlinks = int(nlinks)
+        self.species = list(species)
+        self.nspecies = len(self.species)
+        self.units = list(units) if units is not None else ['MG']*self.nspecies
+        self.reportstep = int(reportstep)
+        self.version = int(version)
+        self.magic = int(magic)
+        self.numreport = 0
+        
+        self._fout = open(filename, 'wb')
+        self._fout.write(np.array([self.magic, self.version, self.nnodes, self.nlinks, 
+                                   self.nspecies, self.reportstep], dtype=np.int32).tobytes())
+        names = [np.int32(len(name)).tobytes() + name.encode('ascii') for name in self.species]
+        units = [unit.encode('ascii')[:16].ljust(16, b'\x00') for unit in self.units]
+        if self.version >= 200000:
+            self._fout.write(b''.join(name + unit for name, unit in zip(names, units)))
+        else:
+            self._fout.write(b''.join(names) + b''.join(units))
+        self.offset = self._fout.tell()
+        self._step_size = self.nspecies * (self.nnodes + self.nlinks)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._fout.close()
+        return False
+    
+    def write_step(self, values):
+        '''
+        Writes one report step, values is (nspecies, nnodes+nlinks) with 
+        nodes first and then links (the layout yielded by iter_msx_bin).
+        '''
+        values = np.asarray(values, dtype=np.float32)
+        if values.size != self._step_size:
+            print(f"ERROR: step has {values.size} values, expected {self._step_size}")
+            return
+        values = values.reshape(self.nspecies, self.nnodes + self.nlinks)
+        ## on disk each step is [species x nodes][species x links]
+        self._fout.write(np.ascontiguousarray(values[:, :self.nnodes]).tobytes())
+        self._fout.write(np.ascontiguousarray(values[:, self.nnodes:]).tobytes())
+        self.numreport += 1
+    
+    def write_steps(self, data):
+        '''
+        Writes a (time, species, element) array, elements are nodes followed by links.
+        '''
+        data = np.asarray(data, dtype=np.float32)
+        if data.ndim != 3 or data.shape[1:] != (self.nspecies, self.nnodes + self.nlinks):
+            print(f"ERROR: data shape {data.shape} does not match (time, {self.nspecies}, {self.nnodes + self.nlinks})")
+            return
+        nodes = data[:, :, :self.nnodes].reshape(data.shape[0], -1)
+        links = data[:, :, self.nnodes:].reshape(data.shape[0], -1)
+        self._fout.write(np.hstack([nodes, links]).tobytes())
+        self.numreport += data.shape[0]
+    
+    def flush(self):
+        self._fout.flush()
+    
+    def close(self, errorcode=0):
+        '''
+        Writes the epilog (results offset, number of report steps, error code,
+        magic number) and closes the file.
+        '''
+        if self._fout.closed:
+            return
+        self._fout.write(np.array([self.offset, self.numreport, errorcode, self.magic], 
+                                  dtype=np.int32).tobytes())
+        self._fout.close()
+
+
+def write_msx_bin(filename, data, nnodes, species, units=None, reportstep=3600, version=200000, errorcode=0):
+    '''
+    Writes a (time, species, element) array as an EPANET-MSX binary file,
+    see MSXBinWriter. Elements are nnodes nodes followed by the links.
+    '''
+    data = np.asarray(data)
+    writer = MSXBinWriter(filename, nnodes, data.shape[2] - nnodes, species, units, reportstep, version)
+    writer.write_steps(data)
+    writer.close(errorcode)
+    return filename
+
 
 # =============================================================================
 # #################### STAND ALONE FUNCTIONS #################################
 # =============================================================================
 
-def MSXBinReader(filename, epanetinpfile):
-    wn = wntr.network.WaterNetworkModel(epanetinpfile)
-    duration = int(wn.options.time.duration)
+def _pattern_compaction_factor(pattern):
+    ## largest k such that the pattern is constant over blocks of k values, and its length a multiple of k
+    values = np.asarray(pattern, dtype=float)
+    if len(values) == 0:
+        return 1
+    changes = np.flatnonzero(values[1:] != values[:-1]) + 1
+    return int(np.gcd.reduce(np.append(changes, len(values))))
+
+
+def _seconds_to_inp_time(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{(seconds % 3600) // 60:02d}:{seconds % 60:02d}"
+
+
+def _read_inp_patterns(inpfile):
+    ## [PATTERNS] of an INP file, pattern ID -> list of multipliers (strings)
+    patterns = {}
+    section = None
+    with open(inpfile, 'r') as f:
+        for line in f:
+            line = line.split(';', 1)[0].strip()
+            if line == '':
+                continue
+            if line[0] == '[':
+                section = line.upper()
+                continue
+            if section == '[PATTERNS]':
+                tokens = line.split()
+                patterns.setdefault(tokens[0], []).extend(tokens[1:])
+    return patterns
+
+
+def _inp_pattern_compaction_factor(inpfile):
+    factors = [_pattern_compaction_factor(p) for p in _read_inp_patterns(inpfile).values()]
+    if len(factors) == 0:
+        return 0 ## no patterns, any factor works (gcd(k, 0) = k)
+    return int(np.gcd.reduce(factors))
+
+
+def compact_inp_patterns(inpfile, factor, new_inpfile):
+    '''
+    Writes a copy of an EPANET INP file with PATTERN TIMESTEP multiplied by
+    factor and every pattern in [PATTERNS] keeping only every factor-th value.
+    Fails (returns False) if any INP pattern is not constant over blocks of
+    factor values, if PATTERN START is not a multiple of the new pattern
+    timestep (the patterns would shift), or if the effective hydraulic
+    timestep would change (EPANET caps HYDRAULIC TIMESTEP at the pattern
+    timestep, so the PATTERN TIMESTEP must not be below HYDRAULIC TIMESTEP).
+
+    Parameters
+    ----------
+    inpfile : string
+        EPANET INP file
+    factor : int
+        pattern timestep multiplier
+    new_inpfile : string
+        file to write
+
+    Returns
+    -------
+    bool, True if the file was written
+
+    '''
+    patterns = _read_inp_patterns(inpfile)
+    for key in patterns.keys():
+        if _pattern_compaction_factor(patterns[key]) % factor != 0:
+            print(f"ERROR: INP pattern {key} cannot be compacted by a factor of {factor}")
+            return False
+    times = read_inp_index(inpfile)['times']
+    new_seconds = times['pattern_timestep'] * factor
+    if times['pattern_start'] % new_seconds != 0:
+        print(f"ERROR: PATTERN START {times['pattern_start']} s is not a multiple of the compacted "
+              f"PATTERN TIMESTEP {new_seconds} s, INP patterns not compacted")
+        return False
+    if min(times['hydraulic_timestep'], new_seconds) != min(times['hydraulic_timestep'], times['pattern_timestep']):
+        print(f"ERROR: HYDRAULIC TIMESTEP {times['hydraulic_timestep']} s is limited by the PATTERN TIMESTEP "
+              f"{times['pattern_timestep']} s, a PATTERN TIMESTEP of {new_seconds} s changes the hydraulics, "
+              f"INP patterns not compacted")
+        return False
+    new_step = _seconds_to_inp_time(new_seconds)
+    
+    out = []
+    section = None
+    step_written = False
+    with open(inpfile, 'r') as f:
+        lines = f.read().split('\n')
+    for line in lines:
+        stripped = line.split(';', 1)[0].strip()
+        if stripped.startswith('['):
+            if section == '[TIMES]' and not step_written:
+                out.append(f" PATTERN TIMESTEP   {new_step}")
+                step_written = True
+            if stripped.upper() == '[END]' and not step_written:
+                ## no [TIMES] section
+                out += ['[TIMES]', f" PATTERN TIMESTEP   {new_step}", '']
+                step_written = True
+            section = stripped.upper()
+            out.append(line)
+            if section == '[PATTERNS]':
+                for key in patterns.keys():
+                    values = patterns[key][::factor]
+                    for i in range(0, len(values), 6):
+                        out.append(f" {key}\t" + '\t'.join(values[i:i+6]))
+            continue
+        if section == '[PATTERNS]' and stripped != '':
+            continue ## already written, compacted
+        if section == '[TIMES]' and stripped != '':
+            tokens = stripped.upper().split()
+            if len(tokens) > 2 and tokens[0] == 'PATTERN' and tokens[1].startswith('TIME'):
+                out.append(f" PATTERN TIMESTEP   {new_step}")
+                step_written = True
+                continue
+        out.append(line)
+    if not step_written:
+        ## [TIMES] is the last section, or missing and there is no [END]
+        if section != '[TIMES]':
+            out += ['', '[TIMES]']
+        out.append(f" PATTERN TIMESTEP   {new_step}")
+    
+    with open(new_inpfile, 'w') as f:
+        f.write('\n'.join(out))
+    print(f"INFO: {new_inpfile} written with PATTERN TIMESTEP {new_step}")
+    return True
+
+
+def _pattern_strings(pattern):
+    ## pattern multipliers as strings, same text as formatting each value in an f-string
+    if isinstance(pattern, np.ndarray) and pattern.dtype in [np.float64, np.int64, np.int32]:
+        return [str(v) for v in pattern.tolist()]
+    return [f"{v}" for v in pattern]
+
+
+def _pattern_fingerprint(pattern):
+    if isinstance(pattern, np.ndarray):
+        return (pattern.dtype.str, pattern.shape, hashlib.sha1(np.ascontiguousarray(pattern).tobytes()).hexdigest())
+    return repr(pattern)
+
+
+inp_cache_location = os.path.join(os.path.expanduser('~'), '.msx_tools', 'inp_index')
+_inp_index_memo = {}
+
+
+def _inp_time_to_seconds(tokens):
+    ## EPANET time values: decimal hours, h:mm or h:mm:ss, optionally followed by a units keyword
+    value = tokens[0]
+    units = tokens[1].upper() if len(tokens) > 1 else ''
+    if ':' in value:
+        parts = [float(p) for p in value.split(':')]
+        hours = parts[0] + parts[1]/60.
+        if len(parts) > 2:
+            hours += parts[2]/3600.
+    else:
+        hours = float(value)
+        if units.startswith('SEC'):
+            hours = hours/3600.
+        elif units.startswith('MIN'):
+            hours = hours/60.
+        elif units.startswith('DAY'):
+            hours = hours*24.
+    if units == 'PM' and hours < 12:
+        hours += 12.
+    elif units == 'AM' and hours >= 12:
+        hours -= 12.
+    return int(round(hours*3600))
+
+
+def _scan_inp_file(inpfile):
+    ## single pass over the INP, only keeps element IDs and [TIMES]
+    junctions = []
+    storage = [] ## tanks and reservoirs share the index range after the junctions, in file order
+    links = []
+    times = {'duration': 0,
+             'hydraulic_timestep': 3600,
+             'quality_timestep': 360,
+             'pattern_timestep': 3600,
+             'pattern_start': 0,
+             'report_timestep': 3600,
+             'report_start': 0}
+    qual_set = False
+    
+    section = None
+    with open(inpfile, 'r') as f:
+        for line in f:
+            line = line.split(';', 1)[0].strip()
+            if line == '':
+                continue
+            if line[0] == '[':
+                section = line[1:line.index(']')].upper() if ']' in line else line[1:].upper()
+                continue
+            
+            if section == 'JUNCTIONS':
+                junctions.append(line.split()[0])
+            elif section in ['RESERVOIRS', 'TANKS']:
+                storage.append(line.split()[0])
+            elif section in ['PIPES', 'PUMPS', 'VALVES']:
+                links.append(line.split()[0])
+            elif section == 'TIMES':
+                tokens = line.split()
+                key = tokens[0].upper()
+                if key.startswith('DURA'):
+                    times['duration'] = _inp_time_to_seconds(tokens[1:])
+                elif key in ['HYDRAULIC', 'QUALITY', 'PATTERN', 'REPORT'] and len(tokens) > 2:
+                    if tokens[1].upper().startswith('TIME'):
+                        times[f"{key.lower()}_timestep"] = _inp_time_to_seconds(tokens[2:])
+                        if key == 'QUALITY':
+                            qual_set = True
+                    elif tokens[1].upper().startswith('START'):
+                        times[f"{key.lower()}_start"] = _inp_time_to_seconds(tokens[2:])
+    
+    if not qual_set:
+        times['quality_timestep'] = times['hydraulic_timestep'] // 10
+    
+    return {'nodes': junctions + storage,
+            'links': links,
+            'njunctions': len(junctions),
+            'times': times}
+
+
+def read_inp_index(inpfile, cache_dir=None, use_cache=True):
+    '''
+    Lightweight replacement for building a WNTR WaterNetworkModel when only the
+    element IDs and time options of an EPANET INP file are needed.
+    
+    Node and link IDs are returned in EPANET's internal ordering (junctions, 
+    then tanks and reservoirs; pipes, pumps and valves in file order), which is
+    the ordering of the EPANET-MSX binary output. Results are cached on disk, 
+    keyed by the SHA-256 of the INP file contents.
+
+    Parameters
+    ----------
+    inpfile : string
+        EPANET INP file
+    cache_dir : string, optional
+        Cache directory. The default is None (~/.msx_tools/inp_index).
+    use_cache : bool, optional
+        Set to False to always rescan the file. The default is True.
+
+    Returns
+    -------
+    inp_index : dictionary
+        'nodes' and 'links' (lists of IDs), 'njunctions' and 'times' (dictionary
+        of duration, timesteps and start times, all in seconds)
+
+    '''
+    with open(inpfile, 'rb') as f:
+        key = hashlib.sha256(f.read()).hexdigest()
+    
+    if use_cache and key in _inp_index_memo:
+        return _inp_index_memo[key]
+    
+    if cache_dir is None:
+        cache_dir = inp_cache_location
+    cache_file = os.path.join(cache_dir, key + '.json')
+    
+    inp_index = None
+    if use_cache and os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'r') as f:
+                inp_index = json.load(f)
+        except Exception as e:
+            print(f"WARNING: could not read cached INP index {cache_file}: {e}")
+    
+    if inp_index is None:
+        inp_index = _scan_inp_file(inpfile)
+        if use_cache:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+                with open(tmp_file, 'w') as f:
+                    json.dump(inp_index, f)
+                os.replace(tmp_file, cache_file) ## atomic, safe for concurrent readers
+            except Exception as e:
+                print(f"WARNING: could not write INP index cache {cache_file}: {e}")
+    
+    if use_cache:
+        _inp_index_memo[key] = inp_index
+    return inp_index
+
+
+def _inp_names(epanetinpfile):
+    ## node/link IDs and report start from an INP file name or an existing WNTR WaterNetworkModel
+    if hasattr(epanetinpfile, 'node_name_list'):
+        wn = epanetinpfile
+        return wn.node_name_list, wn.link_name_list, int(wn.options.time.report_start)
+    inp_index = read_inp_index(epanetinpfile)
+    return inp_index['nodes'], inp_index['links'], inp_index['times']['report_start']
+
+
+def _read_msx_bin_prolog(fin):
+    '''
+    Reads the prolog and species headers of an EPANET-MSX binary file.
+    Leaves the file pointer at the start of the results block.
+
+    Parameters
+    ----------
+    fin : open binary file handle, positioned at the start of the file
+
+    Returns
+    -------
+    header : dictionary
+        magic, version, nnodes, nlinks, nspecies, reportstep, species (names),
+        units and offset (byte position of the results block)
+
+    '''
+    prolog = np.frombuffer(fin.read(24), dtype=np.int32)
+    header = {'magic': int(prolog[0]),
+              'version': int(prolog[1]),
+              'nnodes': int(prolog[2]),
+              'nlinks': int(prolog[3]),
+              'nspecies': int(prolog[4]),
+              'reportstep': int(prolog[5]),
+              'species': [],
+              'units': []}
+    
+    def read_name():
+        species_len = int(np.frombuffer(fin.read(4), dtype=np.int32)[0])
+        return fin.read(species_len).replace(b'\x00', b'').decode('ascii', 'replace')
+    
+    def read_units():
+        return fin.read(16).replace(b'\x00', b'').decode('ascii', 'replace')
+    
+    if header['version'] >= 200000:
+        for i in range(header['nspecies']):
+            header['species'].append(read_name())
+            header['units'].append(read_units())
+    else:
+        # older version of MSX had names then units, rather than name-unit/name-unit as in 2.0 or newer
+        for i in range(header['nspecies']):
+            header['species'].append(read_name())
+        for i in range(header['nspecies']):
+            header['units'].append(read_units())
+    
+    header['offset'] = fin.tell()
+    return header
+
+
+def _read_msx_bin_epilog(fin):
+    '''
+    Reads the 16 byte epilog at the end of an EPANET-MSX binary file.
+    The file pointer is left at the end of the file.
+
+    Returns
+    -------
+    epilog : dictionary
+        offset (byte position of the results block), numreport, errorcode, magic
+
+    '''
+    fin.seek(-16, os.SEEK_END)
+    postlog = np.frombuffer(fin.read(16), dtype=np.int32)
+    return {'offset': int(postlog[0]),
+            'numreport': int(postlog[1]),
+            'errorcode': int(postlog[2]),
+            'magic': int(postlog[3])}
+
+
+
+def _complete_steps(filename, header, epilog):
+    ## report steps to read: the epilog count if the epilog is intact, otherwise the
+    ## complete steps present in the file (aborted or truncated run, no valid epilog)
+    step_bytes = 4 * header['nspecies'] * (header['nnodes'] + header['nlinks'])
+    size = os.path.getsize(filename)
+    if (epilog['magic'] == header['magic'] and epilog['offset'] == header['offset'] and
+            epilog['numreport'] >= 0 and header['offset'] + epilog['numreport'] * step_bytes + 16 <= size):
+        return epilog['numreport']
+    steps = max(size - header['offset'], 0) // step_bytes if step_bytes > 0 else 0
+    print(f"WARNING: Magic#s do not match! {filename} is incomplete, reading its {steps} complete report steps")
+    return steps
+
+
+msx_magic = 516114521
+
+
+def inspect_msx_bin(filename):
+    '''
+    Reads only the prolog, species headers and the 16 byte epilog of an
+    EPANET-MSX binary file (no results are read) and checks them against
+    each other and the file size.
+
+    Parameters
+    ----------
+    filename : string
+        EPANET-MSX binary output file (.bin)
+
+    Returns
+    -------
+    dictionary
+        filename, file_size, magic, version, nnodes, nlinks, nspecies,
+        reportstep, species, units, offset, numreport, errorcode,
+        epilog_magic, expected_size, valid (bool) and problems (list of
+        strings, empty for a complete and error free file)
+
+    '''
+    info = {'filename': filename, 'file_size': os.path.getsize(filename), 'valid': False, 'problems': []}
+    problems = info['problems']
+    if info['file_size'] < 40: ## 24 byte prolog + 16 byte epilog
+        problems.append('file too small')
+        return info
+    with open(filename, 'rb') as fin:
+        ## python ints, prolog[4]*20 overflows as int32 on corrupt files
+        prolog = [int(v) for v in np.frombuffer(fin.read(24), dtype=np.int32)]
+        if prolog[4] < 0 or prolog[2] < 0 or prolog[3] < 0 or prolog[4] * 20 > info['file_size']:
+            problems.append('corrupt prolog')
+            info.update({'magic': int(prolog[0]), 'version': int(prolog[1])})
+            return info
+        fin.seek(0)
+        try:
+            header = _read_msx_bin_prolog(fin)
+        except (IndexError, ValueError):
+            problems.append('truncated species headers')
+            return info
+        info.update(header)
+        epilog = _read_msx_bin_epilog(fin)
+    info['numreport'] = epilog['numreport']
+    info['errorcode'] = epilog['errorcode']
+    info['epilog_magic'] = epilog['magic']
+    step_bytes = 4 * header['nspecies'] * (header['nnodes'] + header['nlinks'])
+    info['expected_size'] = header['offset'] + epilog['numreport'] * step_bytes + 16
+
+    if header['magic'] != msx_magic:
+        problems.append(f"unexpected magic number {header['magic']}")
+    if epilog['magic'] != header['magic']:
+        problems.append('Magic#s do not match (run incomplete or aborted)')
+    else:
+        if epilog['offset'] != header['offset']:
+            problems.append(f"epilog offset {epilog['offset']} differs from header offset {header['offset']}")
+        if info['expected_size'] != info['file_size']:
+            problems.append(f"file size {info['file_size']} differs from expected {info['expected_size']}")
+        if epilog['errorcode'] != 0:
+            problems.append(f"ERROR CODE: {epilog['errorcode']}")
+    info['valid'] = len(problems) == 0
+    return info
+
+
+def inspect_msx_bins(files):
+    '''
+    inspect_msx_bin for many files.
+
+    Parameters
+    ----------
+    files : string or list
+        directory (all .bin files in it), glob pattern, or list of file names
+
+    Returns
+    -------
+    pandas DataFrame, one row per file
+
+    '''
+    if isinstance(files, str):
+        pattern = os.path.join(files, '*.bin') if os.path.isdir(files) else files
+        files = sorted(glob.glob(pattern))
+    rows = []
+    for filename in files:
+        try:
+            rows.append(inspect_msx_bin(filename))
+        except OSError as e:
+            rows.append({'filename': filename, 'valid': False, 'problems': [str(e)]})
+    return pd.DataFrame(rows)
+
+
+def _check_bin(bin_file):
+    ## 'ok' if the binary file exists and its epilog is intact and error free
+    if not os.path.exists(bin_file) or os.path.getsize(bin_file) == 0:
+        return 'error', 'no binary output'
+    try:
+        info = inspect_msx_bin(bin_file)
+    except Exception as e:
+        return 'error', f'unreadable binary output: {e}'
+    if not info['valid']:
+        return 'error', '; '.join(info['problems'])
+    return 'ok', ''
+
+def _msx_bin_memmap(filename, header, nsteps):
+    '''
+    Memory-maps the results block of an EPANET-MSX binary file as a
+    (time, nspecies*(nnodes+nlinks)) float32 array. Nothing is read from disk
+    until the array is indexed.
+    '''
+    ncols = header['nspecies'] * (header['nnodes'] + header['nlinks'])
+    return np.memmap(filename, dtype=np.float32, mode='r', 
+                     offset=header['offset'], shape=(nsteps, ncols))
+
+
+def _select_names(name_list, requested, label):
+    ## returns positions of requested names in name_list, in requested order
+    if requested is None:
+        return list(range(len(name_list)))
+    lookup = {name: i for i, name in enumerate(name_list)}
+    idx = []
+    for name in requested:
+        if str(name) in lookup:
+            idx.append(lookup[str(name)])
+        else:
+            print(f"WARNING: {label} {name} not found, skipping.")
+    return idx
+
+
+@timed('bin_read')
+def MSXBinReader(filename, epanetinpfile, species=None, nodes=None, links=None, time_window=None, 
+                 as_results=False, decimate=None, aggregate=None):
+    '''
+    Reads an EPANET-MSX binary output file into a DataFrame.
+    
+    If species, nodes, links or time_window is given, the results block is
+    memory-mapped and only the requested rows/columns are read from disk.
+    
+    Parameters
+    ----------
+    filename : string
+        EPANET-MSX binary output file (.bin)
+    epanetinpfile : string or WNTR WaterNetworkModel
+        EPANET INP file used for the simulation, supplies node/link names.
+        INP files are scanned with read_inp_index (cached), an already built
+        WaterNetworkModel is used as is.
+    species : list, optional
+        Species to return. The default is None (all species).
+    nodes : list, optional
+        Node IDs to return. The default is None.
+    links : list, optional
+        Link IDs to return. The default is None.
+        If neither nodes nor links are given, all nodes and links are returned.
+        If only one of them is given, only that element type is returned.
+    time_window : tuple, optional
+        (start, end) in seconds, inclusive. The default is None (all times).
+    as_results : bool, optional
+        Return an MSXResults object ((time, species, element) float32 array)
+        instead of a DataFrame. The default is False.
+    decimate : int, optional
+        Keep every decimate-th report step (starting with the first one of
+        the time window), or with aggregate, the size of the aggregation
+        windows in report steps. Only the output resolution is held in
+        memory. The default is None (all steps).
+    aggregate : string, optional
+        'mean', 'max' or 'min' over consecutive windows of decimate report
+        steps, labeled with the time of the first step of the window. The 
+        last window may be shorter. The default is None (no aggregation).
+
+    Returns
+    -------
+    df_fin : pandas DataFrame or MSXResults
+        Columns are a (type, species, name) MultiIndex, index is time in seconds.
+
+    '''
+    node_list, link_list, report_start = _inp_names(epanetinpfile)
+    
+    if decimate is not None or aggregate is not None:
+        results = _msx_bin_results(filename, node_list, link_list, report_start,
+                                   species, nodes, links, time_window, 
+                                   decimate=decimate, aggregate=aggregate)
+        return results if as_results else results.to_dataframe()
+    
+    if as_results:
+        return _msx_bin_results(filename, node_list, link_list, report_start,
+                                species, nodes, links, time_window)
+    
+    if species is not None or nodes is not None or links is not None or time_window is not None:
+        return _msx_bin_subset(filename, node_list, link_list, report_start,
+                               species, nodes, links, time_window)
     
     with open(filename, 'rb') as fin:
           ftype = '=f4'
-          idlen = 32
-          prolog = np.fromfile(fin, dtype = np.int32, count=6)
-          magic1 = prolog[0]
-          version = prolog[1]
-          nnodes = prolog[2] 
-          nlinks = prolog[3]
-          nspecies = prolog[4]
-          reportstep = prolog[5]
-          
-          node_list = wn.node_name_list
-          link_list = wn.link_name_list
-          
-          species_list = []
-          species_mass = []
+          header = _read_msx_bin_prolog(fin)
+          nnodes = header['nnodes']
+          nlinks = header['nlinks']
+          reportstep = header['reportstep']
+          species_list = header['species']
           
-          if version >= 200000:
-              for i in range(nspecies):
-                  species_len = int(np.fromfile(fin, dtype=np.int32, count=1))
-                  species_name = ''.join(chr(f) for f in np.fromfile(fin, dtype=np.uint8, count=species_len) if f!=0)
-                  species_list.append(species_name)
-       
-              # for i in range(nspecies):
-                  species_mass.append(''.join(chr(f) for f in np.fromfile(fin, dtype = np.uint8, count=16) if f != 0))
-          else:
-          # elif version == 100000:
-              # older version of MSX had names then units, rather than name-unit/name-unit as in 2.0 or newer
-              for i in range(nspecies):
-                  species_len = int(np.fromfile(fin, dtype=np.int32, count=1))
-                  species_name = ''.join(chr(f) for f in np.fromfile(fin, dtype=np.uint8, count=species_len) if f!=0)
-                  species_list.append(species_name)
-       
-              for i in range(nspecies):
-                  species_mass.append(''.join(chr(f) for f in np.fromfile(fin, dtype = np.uint8, count=16) if f != 0))
-                      
+          ## number of report steps comes from the epilog, no need for the INP duration
+          postlog = _read_msx_bin_epilog(fin)
+          tr = _complete_steps(filename, header, postlog)
+          fin.seek(header['offset'])
                 
-          timerange = range(0, duration+1, reportstep)
-          tr = len(timerange)
-          
-          # print(species_list, species_mass)
+          timerange = range(report_start, report_start + tr*reportstep, reportstep)
           
           row1 = ['node']*nnodes*len(species_list)+['link']*nlinks*len(species_list)
           row2 = []
@@ -456,38 +1963,519 @@ def MSXBinReader(filename, epanetinpfile):
           tuples = list(zip(row1, row2, row3))
           index = pd.MultiIndex.from_tuples(tuples, names = ['type','species','name'])
           
-          try:
-                  data = np.fromfile(fin, dtype = np.dtype(ftype), count = tr*(len(species_list*(nnodes + nlinks))))
-                  data = np.reshape(data, (tr, len(species_list*(nnodes + nlinks))))
-          except Exception as e:
-              print(e)
-              print ("oops")
+          data = np.fromfile(fin, dtype = np.dtype(ftype), count = tr*(len(species_list*(nnodes + nlinks))))
+          data = np.reshape(data, (tr, len(species_list*(nnodes + nlinks))))
              
-          postlog = np.fromfile(fin, dtype = np.int32, count=4)
-          offset = postlog[0]
-          numreport = postlog[1]
-          errorcode = postlog[2]
-          magicnew = postlog[3] 
-          if errorcode !=0:
-              print(f'ERROR CODE: {errorcode}')
-              print(offset, numreport)
-              
-          df_fin = pd.DataFrame(index=index, columns=timerange).transpose()
-          if magic1 == magicnew:
-              # print("Magic# Match")
-              df_fin = pd.DataFrame(data.transpose(), index=index, columns=timerange)
-              df_fin = df_fin.transpose()
+          if postlog['magic'] == header['magic'] and postlog['errorcode'] != 0:
+              print(f"ERROR CODE: {postlog['errorcode']}")
+              print(postlog['offset'], postlog['numreport'])
               
-          else:
-              print("Magic#s do not match!")
+          df_fin = pd.DataFrame(data, index=timerange, columns=index)
     return df_fin
 
 
+def iter_msx_bin(filename, report_start=0):
+    '''
+    Iterates over the report steps of an EPANET-MSX binary file one at a time,
+    in constant memory. Does not require the EPANET INP file.
+
+    Parameters
+    ----------
+    filename : string
+        EPANET-MSX binary output file (.bin)
+    report_start : int, optional
+        REPORT START of the INP file in seconds, the .bin does not store it
+        (e.g. read_inp_index(inpfile)['times']['report_start']). The default
+        is 0.
+
+    Yields
+    ------
+    time : int
+        time of the report step in seconds, report_start + k*reportstep
+    values : numpy array, float32
+        (nspecies, nnodes+nlinks) concentrations, nodes first and then links
+        in INP order, species in the order of the file header.
+        The same array is reused for every step, copy it if it needs to be kept.
+
+    '''
+    with open(filename, 'rb') as fin:
+        header = _read_msx_bin_prolog(fin)
+        epilog = _read_msx_bin_epilog(fin)
+        if epilog['magic'] != header['magic']:
+            print("Magic#s do not match!")
+            return
+        if epilog['errorcode'] != 0:
+            print(f"ERROR CODE: {epilog['errorcode']}")
+        
+        nnodes = header['nnodes']
+        nlinks = header['nlinks']
+        nspecies = header['nspecies']
+        step = np.empty(nspecies*(nnodes + nlinks), dtype=np.float32)
+        values = np.empty((nspecies, nnodes + nlinks), dtype=np.float32)
+        
+        fin.seek(header['offset'])
+        for k in range(epilog['numreport']):
+            if fin.readinto(step) != step.nbytes:
+                print(f"WARNING: {filename} ended early, at report step {k}")
+                return
+            ## on disk each step is [species x nodes][species x links]
+            values[:, :nnodes] = step[:nspecies*nnodes].reshape(nspecies, nnodes)
+            values[:, nnodes:] = step[nspecies*nnodes:].reshape(nspecies, nlinks)
+            yield report_start + k * header['reportstep'], values
+
+
+
+class MSXBinFollower():
+    def __init__(self, filename, poll_interval=0.5, stall_timeout=None, process=None, report_start=0):
+        """
+        Follows an EPANET-MSX binary file while the engine is still writing
+        it: waits for the prolog, then returns every report step as soon as
+        it is complete, and stops on the epilog (status 'completed', or
+        'error' if the epilog has an error code).
+
+        Without an epilog, following stops with status 'terminated' when
+        process has exited, or 'stalled' when the file has not grown for
+        stall_timeout seconds.
+
+        NOTE: the bundled EPANET-MSX engine writes its .bin from a scratch
+        file at the end of the run, so its steps arrive all at once. Files
+        written with MSXBinWriter (e.g. engine='python') grow step by step.
+
+        Parameters
+        ----------
+        filename : string
+            EPANET-MSX binary output file (.bin), may not exist yet
+        poll_interval : float, optional
+            seconds between checks of the file size. The default is 0.5.
+        stall_timeout : float, optional
+            seconds without growth before giving up. The default is None (wait forever).
+        process : subprocess.Popen or asyncio process, optional
+            the engine process, used to detect abnormal termination. The default is None.
+        report_start : int, optional
+            REPORT START of the INP file in seconds, added to the times
+            yielded by iteration (the .bin does not store it). The default is 0.
+
+        """
+        self.filename = filename
+        self.poll_interval = poll_interval
+        self.stall_timeout = stall_timeout
+        self.process = process
+        self.report_start = report_start
+        self.status = 'waiting'
+        self.header = None
+        self.epilog = None
+        self.steps_read = 0
+        self._fin = None
+        self._last_size = -1
+        self._last_change = time.monotonic()
+
+    def _process_exited(self):
+        if self.process is None:
+            return False
+        if hasattr(self.process, 'poll'):
+            return self.process.poll() is not None
+        return self.process.returncode is not None
+
+    def _complete_epilog(self, size):
+        ## the last 16 bytes are an epilog only if they agree with the header and the file size
+        step_bytes = 4 * self.header['nspecies'] * (self.header['nnodes'] + self.header['nlinks'])
+        if size < self.header['offset'] + 16:
+            return None
+        epilog = _read_msx_bin_epilog(self._fin)
+        if (epilog['magic'] == self.header['magic'] and epilog['offset'] == self.header['offset'] and
+                epilog['numreport'] >= 0 and
+                self.header['offset'] + epilog['numreport'] * step_bytes + 16 == size):
+            return epilog
+        return None
+
+    def read_available(self):
+        """
+        Reads the report steps completed since the last call, without
+        waiting. Updates status.
+
+        Returns
+        -------
+        numpy array, float32
+            (new steps, nspecies, nnodes+nlinks), possibly empty
+            (None while the prolog has not been written)
+
+        """
+        if self.status in ['completed', 'error', 'terminated', 'stalled']:
+            return None if self.header is None else np.empty((0, self.header['nspecies'],
+                                                              self.header['nnodes'] + self.header['nlinks']),
+                                                             dtype=np.float32)
+        exited = self._process_exited() ## before reading, so the final data is read after an exit
+        if self._fin is None and os.path.exists(self.filename):
+            self._fin = open(self.filename, 'rb')
+        size = os.fstat(self._fin.fileno()).st_size if self._fin is not None else 0
+
+        now = time.monotonic()
+        if size != self._last_size:
+            self._last_size = size
+            self._last_change = now
+
+        if self.header is None and size >= 24:
+            try:
+                self._fin.seek(0)
+                header = _read_msx_bin_prolog(self._fin)
+                if header['offset'] < size and header['nspecies'] >= 0:
+                    self.header = header
+                    self.status = 'running'
+            except (IndexError, ValueError):
+                pass ## prolog not complete yet
+
+        new = None
+        if self.header is not None:
+            nspecies = self.header['nspecies']
+            nnodes = self.header['nnodes']
+            nlinks = self.header['nlinks']
+            step_bytes = 4 * nspecies * (nnodes + nlinks)
+            epilog = self._complete_epilog(size)
+            available = epilog['numreport'] if epilog is not None else (size - self.header['offset']) // max(step_bytes, 1)
+            count = max(available - self.steps_read, 0)
+            self._fin.seek(self.header['offset'] + self.steps_read * step_bytes)
+            raw = np.frombuffer(self._fin.read(count * step_bytes), dtype=np.float32)
+            count = raw.size * 4 // step_bytes if step_bytes > 0 else 0 ## steps fully read
+            raw = raw[:count * step_bytes // 4].reshape(count, step_bytes // 4)
+            ## on disk each step is [species x nodes][species x links]
+            new = np.empty((count, nspecies, nnodes + nlinks), dtype=np.float32)
+            new[:, :, :nnodes] = raw[:, :nspecies*nnodes].reshape(count, nspecies, nnodes)
+            new[:, :, nnodes:] = raw[:, nspecies*nnodes:].reshape(count, nspecies, nlinks)
+            self.steps_read += count
+            if epilog is not None and self.steps_read >= epilog['numreport']:
+                self.epilog = epilog
+                self.status = 'completed' if epilog['errorcode'] == 0 else 'error'
+                if epilog['errorcode'] != 0:
+                    print(f"ERROR CODE: {epilog['errorcode']}")
+        if self.status in ['waiting', 'running'] and exited:
+            self.status = 'terminated'
+            print(f"WARNING: engine exited without completing {self.filename}, {self.steps_read} report steps read")
+        elif (self.status in ['waiting', 'running'] and self.stall_timeout is not None and
+              now - self._last_change > self.stall_timeout):
+            self.status = 'stalled'
+            print(f"WARNING: {self.filename} has not grown for {self.stall_timeout} s, {self.steps_read} report steps read")
+        if self.status not in ['waiting', 'running']:
+            self.close()
+        return new
+
+    def __iter__(self):
+        """
+        Yields (time in seconds, (nspecies, nnodes+nlinks) values) for every
+        report step as it is completed, until the run ends (see status).
+        """
+        while True:
+            first = self.steps_read
+            new = self.read_available()
+            if new is not None:
+                for k in range(new.shape[0]):
+                    yield self.report_start + (first + k) * self.header['reportstep'], new[k]
+            if self.status not in ['waiting', 'running']:
+                return
+            time.sleep(self.poll_interval)
+
+    def close(self):
+        if self._fin is not None:
+            self._fin.close()
+            self._fin = None
+
+def _select_elements(header, node_list, link_list, species=None, nodes=None, links=None):
+    ## species/node/link positions for a subset request, see MSXBinReader for the rules
+    species_idx = _select_names(header['species'], species, 'SPECIES')
+    if nodes is None and links is None:
+        node_idx = list(range(header['nnodes']))
+        link_idx = list(range(header['nlinks']))
+    else:
+        node_idx = _select_names(node_list, nodes, 'NODE') if nodes is not None else []
+        link_idx = _select_names(link_list, links, 'LINK') if links is not None else []
+    return species_idx, node_idx, link_idx
+
+
+def _time_window_steps(time_window, report_start, reportstep, tr):
+    ## (start, end) seconds -> [t0, t1) report step positions
+    t0, t1 = 0, tr
+    if time_window is not None:
+        start, end = time_window
+        if start is not None:
+            t0 = min(max(int(np.ceil((start - report_start) / reportstep)), 0), tr)
+        if end is not None:
+            t1 = min(max(int((end - report_start) // reportstep) + 1, t0), tr)
+    return t0, t1
+
+
+def _msx_bin_subset(filename, node_list, link_list, report_start=0, 
+                    species=None, nodes=None, links=None, time_window=None):
+    ## lazy path of MSXBinReader, only touches the requested bytes of the results block
+    with open(filename, 'rb') as fin:
+        header = _read_msx_bin_prolog(fin)
+        epilog = _read_msx_bin_epilog(fin)
+    tr = _complete_steps(filename, header, epilog)
+    if epilog['magic'] == header['magic'] and epilog['errorcode'] != 0:
+        print(f"ERROR CODE: {epilog['errorcode']}")
+    nnodes = header['nnodes']
+    nlinks = header['nlinks']
+    nspecies = header['nspecies']
+    reportstep = header['reportstep']
+    
+    data = _msx_bin_memmap(filename, header, tr)
+    
+    species_idx, node_idx, link_idx = _select_elements(header, node_list, link_list, 
+                                                       species, nodes, links)
+    
+    ## column positions follow the on-disk layout: [species x nodes][species x links]
+    cols = []
+    tuples = []
+    for s in species_idx:
+        for i in node_idx:
+            cols.append(s*nnodes + i)
+            tuples.append(('node', header['species'][s], node_list[i]))
+    for s in species_idx:
+        for i in link_idx:
+            cols.append(nspecies*nnodes + s*nlinks + i)
+            tuples.append(('link', header['species'][s], link_list[i]))
+    
+    t0, t1 = _time_window_steps(time_window, report_start, reportstep, tr)
+    
+    values = np.asarray(data[t0:t1, cols]) if len(cols) > 0 else np.empty((t1-t0, 0), dtype=np.float32)
+    del data
+    
+    index = pd.MultiIndex.from_tuples(tuples, names = ['type','species','name'])
+    return pd.DataFrame(values, index=range(report_start + t0*reportstep, report_start + t1*reportstep, reportstep), 
+                        columns=index)
+
+
+def _msx_bin_results(filename, node_list, link_list, report_start=0, 
+                     species=None, nodes=None, links=None, time_window=None, chunk_steps=1024,
+                     decimate=None, aggregate=None):
+    ## MSXBinReader(as_results=True), fills the (time, species, element) array a chunk of steps at a time
+    if aggregate is not None and aggregate not in _aggregate_functions:
+        raise ValueError(f"aggregate must be one of {list(_aggregate_functions)}, not {aggregate}")
+    if aggregate is not None and decimate is None:
+        raise ValueError("aggregate needs the window size (decimate) in report steps")
+    k = 1 if decimate is None else int(decimate)
+    if k < 1:
+        raise ValueError("decimate must be a positive number of report steps")
+    
+    with open(filename, 'rb') as fin:
+        header = _read_msx_bin_prolog(fin)
+        epilog = _read_msx_bin_epilog(fin)
+    tr = _complete_steps(filename, header, epilog)
+    if epilog['magic'] == header['magic'] and epilog['errorcode'] != 0:
+        print(f"ERROR CODE: {epilog['errorcode']}")
+    nnodes = header['nnodes']
+    nlinks = header['nlinks']
+    nspecies = header['nspecies']
+    reportstep = header['reportstep']
+    
+    species_idx, node_idx, link_idx = _select_elements(header, node_list, link_list, 
+                                                       species, nodes, links)
+    t0, t1 = _time_window_steps(time_window, report_start, reportstep, tr)
+    
+    nout = -(-(t1-t0) // k)
+    out = np.empty((nout, len(species_idx), len(node_idx)+len(link_idx)), dtype=np.float32)
+    data = _msx_bin_memmap(filename, header, tr)
+    ## chunks hold whole windows
+    chunk = max(chunk_steps // k, 1) * k
+    for c0 in range(t0, t1, chunk):
+        c1 = min(c0 + chunk, t1)
+        ## plain decimation only reads the kept steps
+        block = np.asarray(data[c0:c1:k] if aggregate is None else data[c0:c1])
+        nsteps = block.shape[0]
+        node_block = block[:, :nspecies*nnodes].reshape(nsteps, nspecies, nnodes)
+        link_block = block[:, nspecies*nnodes:].reshape(nsteps, nspecies, nlinks)
+        selected = np.concatenate([node_block[:, species_idx][:, :, node_idx],
+                                   link_block[:, species_idx][:, :, link_idx]], axis=2)
+        if aggregate is not None:
+            selected = _aggregate_windows(selected, k, aggregate)
+        o0 = (c0 - t0) // k
+        out[o0:o0 + selected.shape[0]] = selected
+    del data
+    
+    return MSXResults(out, 
+                      range(report_start + t0*reportstep, report_start + t1*reportstep, k*reportstep),
+                      [header['species'][s] for s in species_idx],
+                      [node_list[i] for i in node_idx],
+                      [link_list[i] for i in link_idx],
+                      units=[header['units'][s] for s in species_idx])
+
+
+_aggregate_functions = {'mean': lambda x, axis: np.mean(x, axis=axis, dtype=np.float64), 
+                        'max': np.max, 'min': np.min}
+
+
+def _aggregate_windows(block, k, aggregate):
+    ## (steps, ...) -> (ceil(steps/k), ...), the last window may be partial
+    func = _aggregate_functions[aggregate]
+    nfull = block.shape[0] // k
+    full = func(block[:nfull*k].reshape((nfull, k) + block.shape[1:]), axis=1)
+    if nfull*k == block.shape[0]:
+        return full
+    rest = func(block[nfull*k:], axis=0)
+    return np.concatenate([full, rest[np.newaxis]])
+
+
+
+MSXReportTable = namedtuple('MSXReportTable', ['element_type', 'element', 'species', 'units', 'times', 'values'])
+MSXReportMessage = namedtuple('MSXReportMessage', ['kind', 'line_number', 'text'])
+
+_rpt_block_re = re.compile(r'^\s*<<<\s*(Node|Link)\s+(.+?)\s*>>>', re.IGNORECASE)
+_rpt_message_re = re.compile(r'^\s*\**\s*(error|warning)\b', re.IGNORECASE)
+_rpt_balance_re = re.compile(r'^\s*Water Quality Mass Balance:\s*(\S+)', re.IGNORECASE)
+
+
+def _rpt_time_to_seconds(token):
+    ## hr:min (or hr:min:sec) report times
+    parts = token.split(':')
+    seconds = 0
+    for part, scale in zip(parts, [3600, 60, 1]):
+        seconds += int(part) * scale
+    return seconds
+
+
+def _rpt_table(element_type, element, species, units, rows, report_step, report_start):
+    times = np.empty(len(rows), dtype=np.int64)
+    values = np.full((len(rows), len(species)), np.nan)
+    for k, row in enumerate(rows):
+        times[k] = _rpt_time_to_seconds(row[0])
+        for s, token in enumerate(row[1:len(species)+1]):
+            try:
+                values[k, s] = float(token)
+            except ValueError: ## e.g. -1.#IND
+                pass
+    if report_step is not None:
+        ## the report only prints hr:min, rebuild the exact report times
+        times = report_start + np.arange(len(rows), dtype=np.int64) * int(report_step)
+    return MSXReportTable(element_type, element, species, units, times, values)
+
+
+def iter_msx_rpt(filename, stop_on_error=True, report_step=None, report_start=0):
+    """
+    Streams an EPANET-MSX report file (.rpt), one line at a time.
+
+    Parameters
+    ----------
+    filename : string
+        EPANET-MSX report file
+    stop_on_error : bool, optional
+        Stop reading at the first error message. The default is True.
+    report_step : int, optional
+        Report step in seconds. The report prints times as hr:min only, with
+        report_step the times are rebuilt as report_start + k*report_step.
+        The default is None (times from the hr:min column).
+    report_start : int, optional
+        Report start in seconds, used with report_step. The default is 0.
+
+    Yields
+    ------
+    MSXReportTable
+        (element_type 'node'/'link', element ID, species list, units list,
+        times in seconds, values (time, species) array) for every
+        <<< Node/Link >>> block
+    MSXReportMessage
+        (kind 'error'/'warning'/'mass_balance', line_number, text) for
+        error and warning lines, and one 'mass_balance' message per species
+        with text "species: Initial Mass ..., Final Mass ..."
+
+    """
+    block = None
+    species, units, rows = [], [], []
+    balance = None
+    with open(filename, 'r', errors='replace') as f:
+        for line_number, line in enumerate(f, start=1):
+            match = _rpt_block_re.match(line)
+            if match is not None or (block is not None and _rpt_balance_re.match(line) is not None):
+                if block is not None and len(rows) > 0:
+                    yield _rpt_table(block[0], block[1], species, units, rows, report_step, report_start)
+                block = None
+                if match is not None:
+                    block = (match.group(1).lower(), match.group(2))
+                    species, units, rows = [], [], []
+                    continue
+
+            message = _rpt_message_re.match(line)
+            if message is not None:
+                if block is not None and len(rows) > 0:
+                    yield _rpt_table(block[0], block[1], species, units, rows, report_step, report_start)
+                block = None
+                yield MSXReportMessage(message.group(1).lower(), line_number, line.strip())
+                if stop_on_error and message.group(1).lower() == 'error':
+                    return
+                continue
+
+            tokens = line.split()
+            if block is not None:
+                if len(tokens) == 0 or tokens[0].startswith('---') or tokens[0].lower() == 'page':
+                    continue
+                if tokens[0].lower() == 'time':
+                    if len(species) == 0: ## header repeats after page breaks
+                        species = tokens[1:]
+                    continue
+                if tokens[0].lower() == 'hr:min':
+                    if len(units) == 0:
+                        units = tokens[1:]
+                    continue
+                if ':' in tokens[0]:
+                    rows.append(tokens)
+                    continue
+                ## anything else ends the table
+                if len(rows) > 0:
+                    yield _rpt_table(block[0], block[1], species, units, rows, report_step, report_start)
+                block = None
+                continue
+
+            match = _rpt_balance_re.match(line)
+            if match is not None:
+                balance = [match.group(1) + ':']
+                continue
+            if balance is not None:
+                if len(tokens) == 0:
+                    continue
+                if tokens[0].startswith('==='):
+                    if len(balance) > 1:
+                        yield MSXReportMessage('mass_balance', line_number, ' '.join(balance))
+                        balance = None
+                    continue
+                balance.append(line.strip())
+
+    if block is not None and len(rows) > 0:
+        yield _rpt_table(block[0], block[1], species, units, rows, report_step, report_start)
+
+
+@timed('rpt_read')
+def read_msx_rpt(filename, stop_on_error=True, report_step=None, report_start=0):
+    """
+    Reads the time series tables and messages of an EPANET-MSX report file,
+    see iter_msx_rpt.
+
+    Returns
+    -------
+    dictionary
+        'node', 'link': {ID: DataFrame (time x species)},
+        'errors', 'warnings': lists of (line_number, text),
+        'mass_balance': {species: {'Initial Mass': ..., ...}}
+
+    """
+    out = {'node': {}, 'link': {}, 'errors': [], 'warnings': [], 'mass_balance': {}}
+    for item in iter_msx_rpt(filename, stop_on_error, report_step, report_start):
+        if isinstance(item, MSXReportTable):
+            out[item.element_type][item.element] = pd.DataFrame(item.values, index=item.times, columns=item.species)
+        elif item.kind == 'mass_balance':
+            specie, _, text = item.text.partition(': ')
+            balance = {}
+            for entry in re.findall(r'([A-Za-z ]+):\s*(\S+)', text):
+                try:
+                    balance[entry[0].strip()] = float(entry[1])
+                except ValueError:
+                    pass
+            out['mass_balance'][specie] = balance
+        else:
+            out[item.kind + 's'].append((item.line_number, item.text))
+    return out
+
 def line_parser(line):
     # print(line)
     note = ''
     if ';' in line:
-        head, note = line.split(';')
+        head, note = line.split(';', 1)
     else:
         head = line
     
@@ -504,7 +2492,7 @@ def line_parser_terms(line):
     note = ''
     parsed_list = []
     if ';' in line:
-        head, note = line.split(';')
+        head, note = line.split(';', 1)
     else:
         head = line
     
@@ -528,7 +2516,7 @@ def line_parser_eq(line):
     note = ''
     parsed_list = []
     if ';' in line:
-        head, note = line.split(';')
+        head, note = line.split(';', 1)
     else:
         head = line
     
@@ -548,94 +2536,300 @@ def line_parser_eq(line):
     
     return parsed_list, note
 
-def _read_msx_file_to_dict(filename):
-    #### TODO: NEEDS TO HANDLE type NODE/LINK SPECIES VALUE ; NOTE STYLE
+_section_re = re.compile(r'^\s*\[\s*([^\]]*?)\s*\]')
+_list_sections = ['parameters', 'sources', 'quality', 'report']
+
+
+def _bulk_float_column(rows, col):
+    ## converts one column of parsed rows to floats in a single call, leaves it alone if not numeric
+    if len(rows) == 0:
+        return
+    try:
+        values = np.array([row[col] for row in rows], dtype=float).tolist()
+    except (ValueError, IndexError):
+        return
+    for row, value in zip(rows, values):
+        row[col] = value
 
-    f = open(filename, 'r')
-    file = f.read()
+
+@timed('msx_parse')
+def _read_msx_file_to_dict(filename):
+    '''
+    Single pass tokenizer for EPANET-MSX files. Lines are streamed from the
+    file and each section is consumed by its own reader, section headers are
+    matched with a precompiled pattern, notes are everything after the first ';'. Pattern multipliers are returned as float arrays and
+    the value column of [SOURCES], [PARAMETERS] and [QUALITY] as floats,
+    both converted in bulk once the file is read (see MSXobj).
+    '''
+    read_in_dict = _tokenize_msx_file(filename)
     
-    read_in_dict = {}
-    key_val = None
-    split_file = file.split('\n')
-    
-    for line in split_file:
-        if len(line) > 3: ## only bothers doing something if there is real data in the line
-            if '[' in line and ']' in line:
-                st_idx = line.index('[')
-                en_idx = line.index(']')
-                key_val = line[st_idx+1: en_idx].lower()
-                
-                read_in_dict[key_val] = {}
-                if key_val in ['parameters', 'sources', 'quality', 'report']:
-                    read_in_dict[key_val] = []
-                
-            else: # do something with the data
-                if key_val == 'title':
-                    read_in_dict[key_val] = line
-                elif key_val == 'options':
-                    parsed, note = line_parser(line)
-                    key, val = parsed
-                    read_in_dict[key_val][key] = {'val': val,
-                                                  'note': note}
-                elif key_val in ['species', 'coefficients']:
-                    parsed, note = line_parser(line)
-                    type_name, key, val = parsed
-                    read_in_dict[key_val][key] = {'type': type_name, 
-                                                  'val': val,
-                                                  'note': note}
-                elif key_val == 'terms':
-                    parsed, note = line_parser_terms(line)    
-                    
-                    key, val = parsed
-                    read_in_dict[key_val][key] = {'val': val,
-                                                  'note': note}
-                elif key_val in ['pipes', 'tanks']:
-                    parsed, note = line_parser_eq(line)
-                    type_name, key, val = parsed
-                    read_in_dict[key_val][key] = {'type': type_name,
-                                                  'val': val,
-                                                  'note': note}
-                elif key_val in ['sources', 'quality', 'parameters']:
-                    parsed, note = line_parser(line)
-                    read_in_dict[key_val].append(parsed + [note])
-                elif key_val == 'report':
-                    parsed, note = line_parser(line)
-                    read_in_dict[key_val].append(parsed)
-                elif key_val == 'patterns':
-                    parsed, note = line_parser(line)
-                    if len(parsed) > 0:
-                        pattern = parsed[0]
-                        if pattern not in read_in_dict[key_val].keys():
-                            read_in_dict[key_val][pattern] = []
-                        for item in parsed[1:]:
-                            read_in_dict[key_val][pattern].append(item)
+    ## bulk numeric conversion
+    for pattern in read_in_dict.get('patterns', {}).keys():
+        read_in_dict['patterns'][pattern] = np.array(read_in_dict['patterns'][pattern], dtype=float)
+    _bulk_float_column(read_in_dict.get('parameters', []), 3)
+    _bulk_float_column(read_in_dict.get('quality', []), -2) ## value is before the note for GLOBAL and NODE/LINK rows
+    _bulk_float_column(read_in_dict.get('sources', []), 3)
     
     return read_in_dict
 
 
+def _msx_row_reader(lines, rows, keep_note=True):
+    ## tight loop for the list sections, returns the next section header line (or None at EOF)
+    for line in lines:
+        head, _, note = line.partition(';')
+        if '[' in head and _section_re.match(head) is not None:
+            return line
+        parsed = head.split()
+        if len(parsed) > 0:
+            if keep_note:
+                parsed.append(note.rstrip('\r\n'))
+            rows.append(parsed)
+    return None
+
 
-def run_msx(inpfile, msxfile, engine='32', version='2'):
-    cwd = os.getcwd()
+def _msx_pattern_reader(lines, patterns):
+    ## multipliers are collected as strings, converted to arrays once the file is read
+    for line in lines:
+        head = line.partition(';')[0]
+        if '[' in head and _section_re.match(head) is not None:
+            return line
+        parsed = head.split()
+        if len(parsed) > 0:
+            if parsed[0] not in patterns:
+                patterns[parsed[0]] = []
+            patterns[parsed[0]].extend(parsed[1:])
+    return None
+
+
+def _msx_keyed_reader(lines, section, key_val):
+    ## options, species, coefficients, terms, pipes, tanks and title
+    for line in lines:
+        head, _, note = line.partition(';')
+        if '[' in head and _section_re.match(head) is not None:
+            return line
+        note = note.rstrip('\r\n')
+        if key_val == 'title':
+            if len(line.strip()) > 0:
+                section['title'] = line.rstrip('\r\n')
+            continue
+        
+        parsed = head.split()
+        if len(parsed) == 0: ## blank or comment only line
+            continue
+        if key_val == 'options':
+            section[parsed[0]] = {'val': ' '.join(parsed[1:]),
+                                  'note': note}
+        elif key_val in ['species', 'coefficients']:
+            ## anything after the value (e.g. species tolerances) is kept with the value
+            section[parsed[1]] = {'type': parsed[0], 
+                                  'val': ' '.join(parsed[2:]),
+                                  'note': note}
+        elif key_val == 'terms':
+            section[parsed[0]] = {'val': ''.join(parsed[1:]),
+                                  'note': note}
+        elif key_val in ['pipes', 'tanks']:
+            section[parsed[1]] = {'type': parsed[0],
+                                  'val': ''.join(parsed[2:]),
+                                  'note': note}
+    return None
+
+
+def _tokenize_msx_file(filename):
+    ## dispatches each section to its reader, one section at a time
+    read_in_dict = {}
+    with open(filename, 'r') as f:
+        lines = iter(f)
+        line = None
+        for line in lines:
+            if _section_re.match(line.partition(';')[0]) is not None:
+                break
+        else:
+            return read_in_dict
+        
+        while line is not None:
+            key_val = _section_re.match(line.partition(';')[0]).group(1).lower()
+            if key_val in _list_sections:
+                section = read_in_dict[key_val] = []
+                line = _msx_row_reader(lines, section, keep_note=(key_val != 'report'))
+            elif key_val == 'patterns':
+                section = read_in_dict[key_val] = {}
+                line = _msx_pattern_reader(lines, section)
+            elif key_val == 'title':
+                line = _msx_keyed_reader(lines, read_in_dict, key_val)
+            else:
+                section = read_in_dict[key_val] = {}
+                line = _msx_keyed_reader(lines, section, key_val)
+    
+    return read_in_dict
+
+
+def _engine_location(engine='32', version='2'):
+    ## directory holding the bundled runepanetmsx.exe and its DLLs
     if version == '2' or version == 2:
-        if engine == '32' or engine == '64':
-            os.chdir(f'{msx_location}/EPANET_MSX_2/Release{engine}')
-        elif engine == 32 or engine == 64:
-            os.chdir(f'{msx_location}/EPANET_MSX_2/Release{engine}')
+        if engine in ['32', '64', 32, 64]:
+            return f'{msx_location}/EPANET_MSX_2/Release{engine}'
     elif version == '11' or version == '1.1' or version == 1.1:
-        os.chdir(f"{msx_location}/EPANETMSX")
+        return f"{msx_location}/EPANETMSX"
+    print(f"WARNING: unknown engine {engine} / version {version}, using EPANET-MSX 2 Release32")
+    return f'{msx_location}/EPANET_MSX_2/Release32'
+
+
+def _engine_command(engine='32', version='2', engine_path=None):
+    '''
+    Command prefix used to launch the engine, and the directory it lives in.
+    engine_path overrides the bundled executable, python scripts (.py) are 
+    run with the current interpreter so a local stand-in can be used.
+    '''
+    if engine_path is None and engine == 'python':
+        ## pure python/numpy stand-in (msx_engine.py), runs where the bundled .exe cannot
+        engine_path = f'{msx_location}/msx_engine.py'
+    if engine_path is None:
+        engine_dir = _engine_location(engine, version)
+        engine_path = f'{engine_dir}/runepanetmsx.exe'
+    engine_path = os.path.abspath(engine_path)
+    engine_dir = os.path.dirname(engine_path)
+    if engine_path.endswith('.py'):
+        return [sys.executable, engine_path], engine_dir
+    return [engine_path], engine_dir
+
+
+def run_msx(inpfile, msxfile, engine='32', version='2', engine_path=None, validate=False, cache=None):
+    '''
+    Runs EPANET-MSX. Results (.rpt and .bin) are written next to the MSX file,
+    using the MSX file name.
+
+    Parameters
+    ----------
+    inpfile : string
+        EPANET INP file
+    msxfile : string
+        EPANET-MSX file
+    engine : string, optional
+        '32' or '64' bit bundled engine, or 'python' for the msx_engine.py
+        stand-in (no Windows executable needed). The default is '32'.
+    version : string, optional
+        '2' or '1.1' bundled engine version. The default is '2'.
+    engine_path : string, optional
+        Engine executable (or python script) to use instead of the bundled
+        one. The default is None.
+    validate : bool, optional
+        Check the model with MSXobj.validate first and do not start the
+        engine if it has errors. The default is False.
+    cache : bool, string or msx_cache.MSXRunCache, optional
+        Result cache keyed on the INP and MSX contents, engine files and
+        options. True uses ~/.msx_tools/results, a string is a cache
+        directory. A hit copies the cached .bin/.rpt next to the MSX file
+        without starting the engine. The default is None (no cache).
+
+    Returns
+    -------
+    bin file name, rpt file name (None, None if validation failed)
+
+    '''
+    if validate:
+        check = MSXobj(file_name=msxfile).validate(inpfile)
+        if len(check['errors']) > 0:
+            print(f"ERROR: {msxfile} failed validation, EPANET-MSX not started")
+            return None, None
+    command, engine_dir = _engine_command(engine, version, engine_path)
     
-    job_base, _ = msxfile.split('.')
-    try:
-        subprocess.Popen(['runepanetmsx.exe', 
-                          cwd+'/'+inpfile, 
-                          cwd+'/'+msxfile,
-                          cwd+'/'+job_base+'.rpt', 
-                          cwd+'/'+job_base+'.bin']).communicate()
-    except Exception as e:
-        print('ERROR: Failure to Run EPANET-MSX ')
-        print(e)
-        # os.chdir(cwd)
-    os.chdir(cwd)
+    ## the engine is started in its own directory (DLLs, runvc.bat) rather than 
+    ## changing the working directory of this process
+    job_base, _ = os.path.splitext(os.path.abspath(msxfile))
+    
+    if cache is not None and cache is not False:
+        from msx_cache import as_cache
+        cache = as_cache(cache)
+        key = cache.key(inpfile, msxfile, command, engine_dir, {'engine': engine, 'version': version})
+        cached = cache.get(key, job_base)
+        if cached is not None:
+            print(f"INFO: results for {msxfile} taken from cache {key[:12]}")
+            return cached
+    
+    with span('engine', engine=engine) as info:
+        try:
+            subprocess.Popen(command + [os.path.abspath(inpfile), 
+                                        os.path.abspath(msxfile),
+                                        job_base+'.rpt', 
+                                        job_base+'.bin'], cwd=engine_dir).communicate()
+        except Exception as e:
+            print('ERROR: Failure to Run EPANET-MSX ')
+            print(e)
+        info['bytes_written'] = file_bytes(job_base+'.rpt', job_base+'.bin')
+    
+    if cache is not None and cache is not False:
+        cache.put(key, job_base+'.bin', job_base+'.rpt', {'inpfile': inpfile, 'msxfile': msxfile})
     
-    return cwd+'/'+job_base+'.bin', cwd+'/'+job_base+'.rpt'
+    return job_base+'.bin', job_base+'.rpt'
+
+
+async def run_msx_async(inpfile, msxfile, engine='32', version='2', engine_path=None,
+                        timeout=None, output_callback=None):
+    '''
+    asyncio version of run_msx. The engine's stdout/stderr are streamed line
+    by line while it runs. Cancelling the task or exceeding timeout kills
+    the engine process.
+
+    Parameters
+    ----------
+    inpfile : string
+        EPANET INP file
+    msxfile : string
+        EPANET-MSX file
+    engine : string, optional
+        '32' or '64' bit bundled engine, or 'python' for the msx_engine.py
+        stand-in (no Windows executable needed). The default is '32'.
+    version : string, optional
+        '2' or '1.1' bundled engine version. The default is '2'.
+    engine_path : string, optional
+        Engine executable (or python script) to use instead of the bundled
+        one. The default is None.
+    timeout : float, optional
+        Seconds before the engine is killed and asyncio.TimeoutError is
+        raised. The default is None (no limit).
+    output_callback : function, optional
+        Called as output_callback(stream, line) for every line of engine
+        output, stream is 'stdout' or 'stderr'. The default is None (print).
 
+    Returns
+    -------
+    bin file name, rpt file name
+
+    '''
+    command, engine_dir = _engine_command(engine, version, engine_path)
+    job_base, _ = os.path.splitext(os.path.abspath(msxfile))
+    if output_callback is None:
+        output_callback = lambda stream, line: print(line)
+    
+    proc = await asyncio.create_subprocess_exec(*command, 
+                                                os.path.abspath(inpfile),
+                                                os.path.abspath(msxfile),
+                                                job_base+'.rpt',
+                                                job_base+'.bin',
+                                                cwd=engine_dir,
+                                                stdout=asyncio.subprocess.PIPE,
+                                                stderr=asyncio.subprocess.PIPE)
+    
+    async def pump(stream, name):
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            output_callback(name, line.decode(errors='replace').rstrip('\r\n'))
+    
+    try:
+        await asyncio.wait_for(asyncio.gather(pump(proc.stdout, 'stdout'),
+                                              pump(proc.stderr, 'stderr'),
+                                              proc.wait()), timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        if isinstance(e, asyncio.TimeoutError):
+            print(f'ERROR: EPANET-MSX run {msxfile} killed after {timeout} s')
+        raise
+    
+    if proc.returncode != 0:
+        print(f'ERROR: EPANET-MSX exited with code {proc.returncode} for {msxfile}')
+    
+    return job_base+'.bin', job_base+'.rpt'
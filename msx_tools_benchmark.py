@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+BENCHMARKS FOR THE MSX_TOOLS PARSE -> BUILD -> READ PIPELINE
+
+Generates synthetic workloads (MSX files with N species/coefficients/per-pipe
+parameters, INP files and MSX binary output for 1k/10k/100k element networks)
+and times _read_msx_file_to_dict, MSXobj.__init__, build_msx_file and
+MSXBinReader, with peak memory from tracemalloc. Does not need the EPANET-MSX
+engine. When WNTR is installed, the transport of the python stand-in engine
+(msx_engine.simulate_msx) is timed as well, on synthetic looped networks.
+
+Usage:
+    python msx_tools_benchmark.py                         ## run and print
+    python msx_tools_benchmark.py --quick                 ## small sizes only
+    python msx_tools_benchmark.py --save-baseline base.json
+    python msx_tools_benchmark.py --compare base.json     ## exit code 1 on regression
+
+benchmark_baseline.json (next to this file) is the committed reference, made
+with --quick --repeat 10. Timings are machine specific, regenerate it with the
+same options before comparing on another machine.
+
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import msx_tools
+
+try:
+    import msx_engine
+except ImportError: ## WNTR not installed
+    msx_engine = None
+
+
+def write_synthetic_msx(file_name, n_species=10, n_coefficients=10, n_parameters=1000, pattern_length=3600):
+    '''
+    MSX file with n_species bulk species, n_coefficients constants, one
+    PARAMETER coefficient assigned to n_parameters pipes, one term and pipe
+    rate per species, and one pattern of pattern_length values.
+    '''
+    lines = ['[TITLE]', 'Synthetic benchmark model', '',
+             '[OPTIONS]', '  AREA_UNITS M2', '  RATE_UNITS MIN', '  SOLVER     RK5',
+             '  TIMESTEP   60', '  RTOL       0.0001', '  ATOL       0.0001', '',
+             '[SPECIES]']
+    lines += [f"  BULK S{i}          MG\t\t\t;species {i}" for i in range(n_species)]
+    lines += ['', '[COEFFICIENTS]']
+    lines += [f"  CONSTANT K{i}          {0.001*(i+1)}\t\t\t;rate {i}" for i in range(n_coefficients)]
+    lines += ["  PARAMETER F          0.0\t\t\t;per pipe factor"]
+    lines += ['', '[TERMS]']
+    lines += [f"  R{i}\t\tK{i % n_coefficients}*S{i}*F\t\t\t;" for i in range(n_species)]
+    lines += ['', '[PIPES]']
+    lines += [f"  RATE\tS{i}\t\t-R{i}\t\t\t;" for i in range(n_species)]
+    lines += ['', '[TANKS]']
+    lines += [f"  RATE\tS{i}\t\t0\t\t\t;" for i in range(n_species)]
+    lines += ['', '[SOURCES]', "  CONCEN\tJ0\t\t\t\tS0\t\t1.0\t\t\tP1\t\t\t;", '', '[PARAMETERS]']
+    lines += [f"  PIPE\tP{i}\t\t\t\tF\t\t\t{(i % 10)/10.}\t\t\t;" for i in range(n_parameters)]
+    lines += ['', '[QUALITY]', '  GLOBAL\tS0\t\t\t\t1.0\t\t\t;', '', '[PATTERNS]']
+    values = ((np.arange(pattern_length) // 600) % 2).astype(float)
+    lines += ["  P1\t" + '\t'.join(str(v) for v in values[i:i+10]) for i in range(0, pattern_length, 10)]
+    lines += ['', '[REPORT]', '  NODES\t\tALL\t']
+    with open(file_name, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return file_name
+
+
+def write_synthetic_inp(file_name, n_nodes, n_links):
+    '''
+    INP file with n_nodes junctions and n_links pipes (a chain, closed into
+    loops when there are more links than nodes).
+    '''
+    lines = ['[TITLE]', 'Synthetic benchmark network', '', '[JUNCTIONS]']
+    lines += [f" J{i}\t0\t1" for i in range(n_nodes)]
+    lines += ['', '[PIPES]']
+    lines += [f" P{i}\tJ{i % n_nodes}\tJ{(i + 1) % n_nodes}\t100\t12\t100\t0\tOpen" for i in range(n_links)]
+    lines += ['', '[TIMES]', ' Duration\t24:00', ' Report Timestep\t1:00', '', '[END]']
+    with open(file_name, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return file_name
+
+
+def write_synthetic_engine_inp(file_name, n_nodes, duration='6:00'):
+    '''
+    Runnable INP file for the python engine: a reservoir feeding a chain of
+    n_nodes junctions with demands, closed into loops every 10 junctions.
+    '''
+    lines = ['[TITLE]', 'Synthetic engine benchmark network', '', '[JUNCTIONS]']
+    lines += [f" J{i}\t0\t{0.1 + 0.1 * (i % 3):.1f}" for i in range(n_nodes)]
+    lines += ['', '[RESERVOIRS]', ' R0\t100', '', '[PIPES]', ' P0\tR0\tJ0\t100\t300\t100\t0\tOpen']
+    lines += [f" P{i}\tJ{i - 1}\tJ{i}\t100\t200\t100\t0\tOpen" for i in range(1, n_nodes)]
+    loops = [(i, i + 10) for i in range(0, n_nodes - 10, 10)]
+    lines += [f" P{n_nodes + k}\tJ{a}\tJ{b}\t500\t150\t100\t0\tOpen" for k, (a, b) in enumerate(loops)]
+    lines += ['', '[OPTIONS]', ' Units\tLPS', '', '[TIMES]', f" Duration\t{duration}", ' Hydraulic Timestep\t1:00',
+              ' Report Timestep\t1:00', '', '[END]']
+    with open(file_name, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return file_name
+
+
+def write_synthetic_bin(file_name, n_nodes, n_links, n_species=2, n_steps=25, reportstep=3600, version=200000):
+    '''
+    EPANET-MSX binary output with random concentrations, written one report
+    step at a time with MSXBinWriter.
+    '''
+    rng = np.random.default_rng(0)
+    with msx_tools.MSXBinWriter(file_name, n_nodes, n_links, [f"S{i}" for i in range(n_species)],
+                                reportstep=reportstep, version=version) as writer:
+        for k in range(n_steps):
+            writer.write_step(rng.random((n_species, n_nodes + n_links), dtype=np.float32))
+    return file_name
+
+
+def measure(func, repeat=3):
+    '''
+    Best wall time over repeat calls, and the peak traced memory of one call.
+    Output printed by func is suppressed.
+    '''
+    times = []
+    for i in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': min(times), 'peak_mb': peak / 2**20}
+
+
+def run_benchmarks(work_dir, quick=False, repeat=3):
+    results = {}
+
+    msx_sizes = [10, 100] if quick else [10, 100, 1000]
+    param_sizes = [1000, 10000] if quick else [1000, 10000, 100000]
+    for n in msx_sizes:
+        for n_param in param_sizes:
+            msx_file = write_synthetic_msx(os.path.join(work_dir, f"syn_{n}_{n_param}.msx"),
+                                           n_species=n, n_coefficients=n, n_parameters=n_param)
+            label = f"species={n},coeffs={n},params={n_param}"
+            results[f"_read_msx_file_to_dict[{label}]"] = measure(
+                lambda: msx_tools._read_msx_file_to_dict(msx_file), repeat)
+            results[f"MSXobj.__init__[{label}]"] = measure(
+                lambda: msx_tools.MSXobj(file_name=msx_file), repeat)
+            with contextlib.redirect_stdout(io.StringIO()):
+                obj = msx_tools.MSXobj(file_name=msx_file)
+            out_file = os.path.join(work_dir, 'out.msx')
+
+            def cold_build():
+                obj._section_cache = {}
+                obj.build_msx_file(out_file)
+            results[f"build_msx_file[{label}]"] = measure(cold_build, repeat)
+
+            def coefficient_rebuild():
+                obj.update_coefficient('K0', np.random.rand())
+                obj.build_msx_file(out_file)
+            results[f"build_msx_file(coefficient change)[{label}]"] = measure(coefficient_rebuild, repeat)
+
+    element_sizes = [1000, 10000] if quick else [1000, 10000, 100000]
+    for n_elements in element_sizes:
+        n_nodes = n_elements // 2
+        n_links = n_elements - n_nodes
+        inp_file = write_synthetic_inp(os.path.join(work_dir, f"net_{n_elements}.inp"), n_nodes, n_links)
+        bin_file = write_synthetic_bin(os.path.join(work_dir, f"net_{n_elements}.bin"), n_nodes, n_links)
+        label = f"elements={n_elements}"
+        msx_tools.read_inp_index(inp_file) ## INP scan cached before timing, as in repeated use
+        results[f"MSXBinReader[{label}]"] = measure(
+            lambda: msx_tools.MSXBinReader(bin_file, inp_file), repeat)
+        results[f"MSXBinReader(as_results)[{label}]"] = measure(
+            lambda: msx_tools.MSXBinReader(bin_file, inp_file, as_results=True), repeat)
+        results[f"MSXBinReader(subset)[{label}]"] = measure(
+            lambda: msx_tools.MSXBinReader(bin_file, inp_file, species=['S0'], nodes=['J0', 'J1']), repeat)
+
+    if msx_engine is None:
+        print("WARNING: WNTR is not installed, python engine benchmarks skipped")
+        return results
+    engine_sizes = [1000] if quick else [1000, 10000]
+    for n_nodes in engine_sizes:
+        inp_file = write_synthetic_engine_inp(os.path.join(work_dir, f"engine_{n_nodes}.inp"), n_nodes)
+        msx_file = write_synthetic_msx(os.path.join(work_dir, f"engine_{n_nodes}.msx"), n_species=2,
+                                       n_coefficients=2, n_parameters=n_nodes)
+        bin_file = os.path.join(work_dir, f"engine_{n_nodes}.bin")
+        with contextlib.redirect_stdout(io.StringIO()):
+            hydraulics = msx_engine.msx_hydraulics(inp_file)
+        label = f"nodes={n_nodes},steps=360"
+        results[f"simulate_msx[{label}]"] = measure(
+            lambda: msx_engine.simulate_msx(inp_file, msx_file, bin_file, hydraulics=hydraulics), repeat)
+
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        return ''
+
+
+def compare(results, baseline, tolerance=0.25):
+    '''
+    Prints current vs baseline times, returns the names of benchmarks slower
+    than the baseline by more than tolerance (fraction).
+    '''
+    regressions = []
+    print(f"\n{'benchmark':75s} {'base s':>10s} {'now s':>10s} {'ratio':>7s}")
+    for name, current in results.items():
+        if name not in baseline['results']:
+            continue
+        base = baseline['results'][name]['seconds']
+        ratio = current['seconds'] / base if base > 0 else np.inf
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f"{name:75s} {base:10.4f} {current['seconds']:10.4f} {ratio:7.2f}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='msx_tools benchmarks')
+    parser.add_argument('--quick', action='store_true', help='small workloads only')
+    parser.add_argument('--repeat', type=int, default=3, help='timed calls per benchmark (best is kept)')
+    parser.add_argument('--save-baseline', metavar='FILE', help='store results as a baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare against a stored baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown vs baseline, fraction')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix='msx_bench_') as work_dir:
+        results = run_benchmarks(work_dir, quick=args.quick, repeat=args.repeat)
+
+    print(f"{'benchmark':75s} {'seconds':>10s} {'peak MB':>10s}")
+    for name, result in results.items():
+        print(f"{name:75s} {result['seconds']:10.4f} {result['peak_mb']:10.1f}")
+
+    record = {'commit': _git_commit(),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'machine': platform.platform(),
+              'quick': args.quick,
+              'results': results}
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(record, f, indent=1)
+        print(f"INFO: baseline saved to {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        print(f"\nBaseline commit {baseline.get('commit', '')}, current commit {record['commit']}")
+        regressions = compare(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print(f"\n{len(regressions)} regression(s) over {args.tolerance:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,6 +7,8 @@ Created on Wed Jun 29 11:19:51 2022
 
 import msx_tools
 import numpy as np
+import os
+import tempfile
 
 
 test1 = True ## Build from scratch
@@ -17,6 +19,14 @@ test4 = True ## run msx file with msx_tools.run_msx()
 
 test5 = True ## Lead model
 
+test6 = True ## MSXBinWriter round trip
+
+test7 = True ## truncated binary file (aborted run)
+
+test8 = True ## INP pattern compaction checks
+
+test9 = True ## HDF5 store with reserved species names
+
 
 
 if test1:
@@ -87,12 +97,11 @@ if test4:
     inp_fn = 'input_files/updated.inp'  ## name of input file
     bin_name, rpt_name = msx_tools.run_msx(inp_fn, 'new.msx')
     
-    rpt_file = open(rpt_name, 'r').readlines()
+    report = msx_tools.read_msx_rpt(rpt_name)
     no_errors = True
-    for line in rpt_file:
-        if 'Error' in line:
-            print('ERROR found in report file')
-            no_errors = False
+    for line_number, text in report['errors']:
+        print(f'ERROR found in report file, line {line_number}: {text}')
+        no_errors = False
     
     if no_errors:
         # msxobj = msx_tools.MSXobj(file_name='new.msx')
@@ -112,3 +121,66 @@ if test5:
     msxobj.update_coefficient('M', 0.12)
     msxobj.build_msx_file(file_name='lead_test.msx')
         
+
+if test6:
+    print('Test #6: Write and read back MSX binary output')
+    results = msx_tools.MSXBinReader('new.bin', 'input_files/updated.inp', as_results=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        roundtrip_file = os.path.join(tmp, 'roundtrip.bin')
+        msx_tools.write_msx_bin(roundtrip_file, results.data, results.nnodes, results.species, 
+                                results.units, reportstep=1)
+        roundtrip = msx_tools.MSXBinReader(roundtrip_file, 'input_files/updated.inp', as_results=True)
+    if not np.array_equal(results.data, roundtrip.data):
+        print('ERROR: binary round trip does not reproduce the data')
+
+
+if test7:
+    print('Test #7: Read a truncated MSX binary output file')
+    with open('new.bin', 'rb') as fin:
+        header = msx_tools._read_msx_bin_prolog(fin)
+        fin.seek(0)
+        raw = fin.read()
+    step_bytes = 4 * header['nspecies'] * (header['nnodes'] + header['nlinks'])
+    full = msx_tools.MSXBinReader('new.bin', 'input_files/updated.inp')
+    with tempfile.TemporaryDirectory() as tmp:
+        truncated_file = os.path.join(tmp, 'truncated.bin')
+        with open(truncated_file, 'wb') as fout:
+            fout.write(raw[:header['offset'] + 1000*step_bytes + 100]) ## no epilog, partial last step
+        for kw in [{}, {'as_results': True}, {'species': ['HOCL']}]:
+            truncated = msx_tools.MSXBinReader(truncated_file, 'input_files/updated.inp', **kw)
+            nsteps = len(truncated.times) if kw.get('as_results') else len(truncated.index)
+            if nsteps != 1000:
+                print(f'ERROR: truncated file read {nsteps} report steps instead of 1000 ({kw})')
+        if not full.iloc[:1000].equals(msx_tools.MSXBinReader(truncated_file, 'input_files/updated.inp')):
+            print('ERROR: truncated file does not reproduce the complete report steps')
+
+
+if test8:
+    print('Test #8: Compact INP patterns only when the results cannot change')
+    inp = ('[JUNCTIONS]\n J1\t0\t1\tP1\n\n[RESERVOIRS]\n R1\t10\n\n[PIPES]\n P1\tR1\tJ1\t100\t100\t100\t0\tOpen\n\n'
+           '[PATTERNS]\n P1\t1\t1\t2\t2\n\n[TIMES]\n Duration 4:00\n{times}\n[END]\n')
+    cases = {'valid': (' Hydraulic Timestep 1:00\n Pattern Timestep 1:00\n', True),
+             'pattern start': (' Pattern Timestep 1:00\n Pattern Start 1:00\n', False),
+             'hydraulic timestep': (' Hydraulic Timestep 2:00\n Pattern Timestep 1:00\n', False)}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, (times, expected) in cases.items():
+            inpfile = os.path.join(tmp, name.replace(' ', '_') + '.inp')
+            with open(inpfile, 'w') as f:
+                f.write(inp.format(times=times))
+            if msx_tools.compact_inp_patterns(inpfile, 2, inpfile + '.compact') != expected:
+                print(f'ERROR: compact_inp_patterns with {name} did not return {expected}')
+
+
+if test9:
+    print('Test #9: HDF5 store with species named like its reserved datasets')
+    import msx_store
+    results = msx_tools.MSXBinReader('new.bin', 'input_files/updated.inp', as_results=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        binfile = os.path.join(tmp, 'reserved.bin')
+        msx_tools.write_msx_bin(binfile, results.data, results.nnodes, ['names', 'A/B'], 
+                                results.units, reportstep=1)
+        h5file = msx_store.msx_bin_to_hdf5(binfile, 'input_files/updated.inp', os.path.join(tmp, 'reserved.h5'))
+        stored = msx_store.read_msx_hdf5(h5file)
+        expected = msx_tools.MSXBinReader(binfile, 'input_files/updated.inp')
+    if not expected.equals(stored):
+        print('ERROR: HDF5 store does not reproduce species names and IDs')